@@ -1,5 +1,5 @@
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, String, INTEGER
+from sqlalchemy import Column, String, INTEGER, Float, Index
 import json
 
 Base = declarative_base()
@@ -36,8 +36,16 @@ class BaseDescription(Base):
 
 class DicomFileSavingPath(Base):
     __tablename__ = "DicomFileSavingPath"
+    __table_args__ = (
+        # 按Series查询文件时走索引范围扫描，并直接按InstanceNumber有序返回
+        Index('ix_DicomFileSavingPath_SeriesInstanceUID_InstanceNumber', 'SeriesInstanceUID', 'InstanceNumber'),
+    )
     SeriesSequenceID = Column(String(64), primary_key=True)
     RelativePath = Column(String(256), nullable=False)
+    SeriesInstanceUID = Column(String(64))
+    InstanceNumber = Column(INTEGER)
+    # 与GetGDCMSeriesFileNames一致的切片位置，建库扫描标签时计算，按它排序即为检索时读取切片的顺序
+    SlicePosition = Column(Float)
 
     def __repr__(self):
         return self.SeriesSequenceID
@@ -0,0 +1,66 @@
+"""
+启动耗时基准：每个目标在新的Python进程中导入，重复多次取中位数，并列出导入后已加载的重型依赖
+用法：python benchmark_startup.py [--repeat 5] [--cold]
+--cold 使用空的字节码缓存目录，模拟首次部署或容器冷启动(没有pyc和数据字典缓存)的情况
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+HEAVY_MODULES = ['torch', 'torchvision', 'faiss', 'SimpleITK', 'description']
+
+TARGETS = [
+    ('description.py字典字面量', 'import description'),
+    ('紧凑数据字典首次查询', 'from dicom_dictionary import lookup_tag; lookup_tag(0x00100010)'),
+    ('read_dicom', 'import read_dicom'),
+    ('data_operations', 'import data_operations'),
+    ('main', 'import main'),
+]
+
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+{code}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'elapsed': elapsed, 'loaded': [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+
+def measure(code, repeat: int, cold: bool):
+    project_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [project_dir, os.environ.get('PYTHONPATH')])))
+    timings = []
+    loaded = []
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as pycache_dir:
+            if cold:
+                env['PYTHONPYCACHEPREFIX'] = pycache_dir
+            process = subprocess.run([sys.executable, '-c', _PROBE.format(code=code, heavy=HEAVY_MODULES)],
+                                     env=env, capture_output=True, text=True)
+        if process.returncode != 0:
+            return None, []
+        result = json.loads(process.stdout.strip().splitlines()[-1])
+        timings.append(result['elapsed'] * 1000)
+        loaded = result['loaded']
+    return statistics.median(timings), loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description='测量各模块的导入耗时')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--cold', action='store_true', help='不使用已有的字节码缓存')
+    args = parser.parse_args()
+    for label, code in TARGETS:
+        elapsed, loaded = measure(code, args.repeat, args.cold)
+        if elapsed is None:
+            print(f"{label:<24}{'导入失败':>10}")
+        else:
+            print(f"{label:<24}{elapsed:>10.1f} ms    已加载: {', '.join(loaded) or '-'}")
+
+
+if __name__ == '__main__':
+    main()
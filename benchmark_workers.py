@@ -0,0 +1,76 @@
+"""
+worker内存基准：分别在两种方式下fork出多个worker，每个worker进行一次推理后报告自身的内存占用
+1. 各自加载：父进程不加载模型，每个worker自己加载(与uvicorn --workers相同)
+2. 共享权重：父进程加载模型并移动到共享内存后再fork(serve.py的方式)
+私有内存(Private)是每增加一个worker实际增加的内存，RSS中包含与其他进程共享的页，不能直接相加
+用法：python benchmark_workers.py [--workers 4] [--image-size 512]
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+_PROBE = """
+import json, os
+import torch
+import serve
+from model_backend import model_registry, get_feature_vectors
+from config import *
+
+def memory_mb():
+    usage = {{}}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            fields = line.split()
+            if fields[0] in ('Rss:', 'Pss:', 'Private_Clean:', 'Private_Dirty:'):
+                usage[fields[0][:-1]] = int(fields[1]) / 1024
+    return {{'rss': usage['Rss'], 'pss': usage['Pss'], 'private': usage['Private_Clean'] + usage['Private_Dirty']}}
+
+def worker(write_fd):
+    for tomography_type in type_config:
+        get_feature_vectors(model_registry.get(tomography_type), [torch.zeros(1, 4, {size}, {size})])
+    os.write(write_fd, (json.dumps(memory_mb()) + '\\n').encode())
+
+if {shared}:
+    model_registry.preload(share_memory=True)
+read_fd, write_fd = os.pipe()
+pids = serve.fork_workers({workers}, worker, write_fd)
+os.close(write_fd)
+for pid in pids:
+    os.waitpid(pid, 0)
+with os.fdopen(read_fd) as f:
+    print(json.dumps([json.loads(line) for line in f]))
+"""
+
+
+def measure(workers: int, image_size: int, shared: bool):
+    project_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [project_dir, os.environ.get('PYTHONPATH')])))
+    process = subprocess.run([sys.executable, '-c', _PROBE.format(workers=workers, size=image_size, shared=shared)],
+                             env=env, capture_output=True, text=True)
+    if process.returncode != 0:
+        print(process.stderr, file=sys.stderr)
+        return None
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='比较worker之间共享模型权重前后每个worker的内存占用')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--image-size', type=int, default=512)
+    args = parser.parse_args()
+    for label, shared in (('各自加载', False), ('共享权重', True)):
+        results = measure(args.workers, args.image_size, shared)
+        if results is None:
+            print(f'{label:<10}测量失败')
+            continue
+        private = sum(result['private'] for result in results) / len(results)
+        rss = sum(result['rss'] for result in results) / len(results)
+        pss = sum(result['pss'] for result in results)
+        print(f'{label:<10}每个worker私有内存 {private:>8.1f} MB    RSS {rss:>8.1f} MB    '
+              f'{len(results)}个worker的PSS合计 {pss:>8.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -13,25 +13,166 @@ need_tags = {
     '0020|0013': 'InstanceNumber'
 }
 
+# ---------- offline build pipeline configs ---------- #
+pipeline_config = {
+    # 并行读取Dicom文件标签的进程数，为None时使用全部CPU核心
+    'scan_workers': None,
+    # 每个进程一次处理的文件数量
+    'scan_chunksize': 256,
+    # 批量插入数据库时每批的行数
+    'insert_batch_size': 5000,
+    # 并行读取解码Dicom序列的线程数
+    'decode_workers': 4,
+    # 各阶段之间队列的最大长度(Series数量)
+    'queue_size': 64
+}
+
+# ---------- serving configs ---------- #
+serve_config = {
+    # 按IndexID缓存的热点描述记录数量，为0时不缓存
+    'description_cache_size': 1024,
+    # 下载Series压缩包的磁盘缓存目录，为None时不缓存，每次都流式生成
+    'zip_cache_dir': None,
+    # 压缩包缓存的最大总字节数，超过后淘汰最久未访问的压缩包
+    'zip_cache_max_bytes': 2 * 1024 ** 3,
+    # 上传的zip中单个Dicom文件解压后的最大字节数
+    'upload_max_member_bytes': 64 * 1024 ** 2,
+    # 批量检索接口单次请求允许的最大查询数量
+    'batch_search_max_queries': 1000,
+    # 以只读内存映射方式打开Faiss基础索引，多个worker进程共享同一份索引数据
+    'index_mmap': True,
+    # serve.py启动的worker进程数量，模型在父进程中加载一次后由所有worker共享
+    'workers': 4
+}
+
+# ---------- database configs ---------- #
+database_config = {
+    'url': 'sqlite:///DicomRetrieve.db',
+    # WAL模式下读操作不会被正在进行的写事务阻塞，数据库文件不能放在网络文件系统上
+    'journal_mode': 'WAL',
+    # WAL模式下NORMAL只在检查点时同步磁盘，断电时可能丢失最近提交的事务，但不会损坏数据库
+    'synchronous': 'NORMAL',
+    # 每个连接的页缓存大小(KB)
+    'cache_size_kb': 64 * 1024,
+    # 以内存映射方式读取数据库文件的最大字节数，为0时不使用内存映射
+    'mmap_size': 256 * 1024 ** 2,
+    # 遇到其他进程持有写锁时的最长等待时间(毫秒)，同一进程内等待写连接或只读连接空闲的时间也以此为上限
+    'busy_timeout_ms': 5000,
+    # 只读连接池的连接数，写操作在每个进程中只使用一个连接
+    'read_pool_size': 8
+}
+
+# ---------- online stage executor configs ---------- #
+# workers: 同时执行的任务数，max_pending: 线程全忙时允许排队的任务数，超出后接口返回503
+executor_config = {
+    'decode': {'workers': 4, 'max_pending': 16},
+    'inference': {'workers': 1, 'max_pending': 32},
+    'db': {'workers': 4, 'max_pending': 64}
+}
+
 # ---------- tomography type configs ---------- #
 from base import *
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, text
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
 
 
-def create_meta_session(database_url, expire_on_commit: bool = False):
-    engine = create_engine(database_url)
-    Base.metadata.create_all(engine)
+def migrate_database(engine):
+    """
+    为旧版本数据库的路径表补充SeriesInstanceUID和InstanceNumber列及其索引，数据由主键SeriesSequenceID拆分得到；
+    补充SlicePosition列，旧数据为空，读取这些Series时再从文件头计算
+    """
+    columns = {column['name'] for column in inspect(engine).get_columns(DicomFileSavingPath.__tablename__)}
+    if 'SeriesInstanceUID' not in columns:
+        with engine.begin() as connection:
+            connection.execute(text('ALTER TABLE "DicomFileSavingPath" ADD COLUMN "SeriesInstanceUID" VARCHAR(64)'))
+            connection.execute(text('ALTER TABLE "DicomFileSavingPath" ADD COLUMN "InstanceNumber" INTEGER'))
+            # SeriesInstanceUID只包含数字和点，主键中第一个'-'即为分隔符
+            connection.execute(text(
+                'UPDATE "DicomFileSavingPath" SET '
+                '"SeriesInstanceUID" = substr("SeriesSequenceID", 1, instr("SeriesSequenceID", \'-\') - 1), '
+                '"InstanceNumber" = CAST(substr("SeriesSequenceID", instr("SeriesSequenceID", \'-\') + 1) AS INTEGER)'))
+    if 'SlicePosition' not in columns:
+        with engine.begin() as connection:
+            connection.execute(text('ALTER TABLE "DicomFileSavingPath" ADD COLUMN "SlicePosition" FLOAT'))
+    for index in DicomFileSavingPath.__table__.indexes:
+        index.create(bind=engine, checkfirst=True)
+
+
+def create_sqlite_engine(database_url, read_only: bool = False):
+    """
+    创建SQLite的engine，每个新连接建立时按database_config设置PRAGMA
+    :param read_only: 为True时创建只读连接池(query_only)，否则创建只有一个连接的写连接池，
+                      同一进程内的写操作依次使用该连接，不会在SQLite的写锁上互相竞争
+    """
+    pool_size = database_config['read_pool_size'] if read_only else 1
+    engine = create_engine(database_url, poolclass=QueuePool, pool_size=pool_size, max_overflow=0,
+                           pool_timeout=database_config['busy_timeout_ms'] / 1000,
+                           connect_args={'check_same_thread': False})
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # journal_mode保存在数据库文件中，只需由写连接设置
+        if not read_only:
+            cursor.execute(f"PRAGMA journal_mode = {database_config['journal_mode']}")
+        cursor.execute(f"PRAGMA synchronous = {database_config['synchronous']}")
+        cursor.execute(f"PRAGMA cache_size = {-int(database_config['cache_size_kb'])}")
+        cursor.execute(f"PRAGMA mmap_size = {int(database_config['mmap_size'])}")
+        cursor.execute(f"PRAGMA busy_timeout = {int(database_config['busy_timeout_ms'])}")
+        if read_only:
+            cursor.execute('PRAGMA query_only = ON')
+        cursor.close()
+
+    return engine
+
+
+def create_meta_session(database_url, expire_on_commit: bool = False, read_only: bool = False):
+    engine = create_sqlite_engine(database_url, read_only)
+    if not read_only:
+        Base.metadata.create_all(engine)
+        migrate_database(engine)
     return sessionmaker(bind=engine, expire_on_commit=expire_on_commit)
 
 
-meta_session = create_meta_session('sqlite:///DicomRetrieve.db', expire_on_commit=False)
+def dispose_engines():
+    """
+    关闭连接池中的所有连接，fork出子进程之前调用，子进程不会继承父进程的数据库连接
+    """
+    for session_factory in (meta_session, read_session):
+        session_factory.kw['bind'].dispose()
+
+
+# 写入和删除使用的session，每个进程只有一个写连接
+meta_session = create_meta_session(database_config['url'], expire_on_commit=False)
+# 检索等只读查询使用的session，WAL模式下不会被正在进行的建库写入阻塞
+read_session = create_meta_session(database_config['url'], expire_on_commit=False, read_only=True)
 
 type_config = {
     'LumbarDisc':
         {
             'index_file': 'LumbarDisc.index',
             'model_file': 'model_resnet34.pth',
-            'feature_vector_length': 128
+            # 持久化特征向量库的目录，重建索引时直接读取其中的向量
+            'vector_store': 'LumbarDisc.vectors',
+            'feature_vector_length': 128,
+            # 建库和重建索引时每次前向推理的序列数量
+            'batch_size': 32,
+            # 在线查询时动态合并推理的最大请求数和最长等待时间(毫秒)
+            'max_batch': 16,
+            'max_wait_ms': 5,
+            # Faiss索引工厂字符串：'Flat'为暴力检索；数据量较大时可使用'IVF4096,Flat'、'HNSW32'，
+            # 千万级数据可使用'IVF65536,PQ32'等压缩索引，修改后需要重建索引
+            'index_factory': 'Flat',
+            # IVF、PQ等需要训练的索引使用的训练向量数量，一般为聚类中心数量的30~256倍
+            'train_size': 100000,
+            # 默认检索范围：IVF为nprobe，HNSW为efSearch，越大召回率越高、速度越慢，暴力检索时忽略
+            'search_effort': 16,
+            # 删除的Series先作为墓碑在检索时过滤，超过该数量后才从索引中真正删除
+            'max_tombstones': 1000,
+            # 增量建库写入的增量段超过该数量后，在后台合并到基础索引
+            'max_delta_segments': 8,
+            # 增量段中的向量总数超过该数量后也在后台合并，单次大批量建库产生的增量段不会长期使用暴力检索
+            'max_delta_rows': 50000
         }
 }
@@ -1,43 +1,173 @@
 """
 离线处理流程：
-1. 读取目标目录下的所有dcm文件，并提取其需要的tags，拼接文件的相对路径，并读取或创建新的Faiss Index（判断是否存在索引文件）
-2. 构建描述表和路径表对应的数据行，添加到数据库，并将成功存入数据库的所有数据对象保存到列表中
+1. 读取目标目录下的所有dcm文件，并提取其需要的tags，拼接文件的相对路径
+2. 构建描述表和路径表对应的数据行，在一个事务中批量插入数据库，并将新插入的所有数据对象保存到列表中
 3. 添加完目录下的所有文件后，对列表中的SeriesID进行迭代，读取其AcquisitionNumber和SeriesID以及自增的IndexID
-4. 拼接所有的dcm文件路径表主键，读取目录信息，然后移动到临时目录，此时临时目录内都是同一个Series的Dicom文件
-5. 对目录下所有Dicom文件进行读取、图像预处理，并使用模型推理出特征向量
-6. 向Faiss索引中添加带id的记录，id为数据库内自增的IndexID
-7. 提交数据库、保存Faiss索引
+4. 通过路径表的SeriesInstanceUID索引，按InstanceNumber顺序查询出同一个Series的所有Dicom文件路径
+5. 直接对这些Dicom文件进行读取、图像预处理，并使用模型推理出特征向量
+6. 向Faiss索引中添加带id的记录，id为数据库内自增的IndexID：索引文件不存在时新建基础索引，否则写入一个新的增量段
+7. 提交数据库、原子保存Faiss索引，并切换服务进程内常驻的索引，增量段过多时在后台合并到基础索引
 
 注意事项：
-1. 由于faiss的删除向量时间复杂度为O(n)，故不提供删除功能，请直接使用delete_by_series_id函数在数据库中删除记录后重建faiss索引，经测试，在RTX2060上，可以达到每秒钟25个Dicom序列的重建
+1. torch等深度学习框架只在需要计算特征向量的建库和重建流程中导入，只进行查询、删除或压缩索引时不加载
+2. delete_by_series_id删除数据库记录后，将其IndexID记录为墓碑，检索时立即过滤；由于faiss删除向量的时间复杂度为O(n)，
+   墓碑数量超过type_config中的max_tombstones后才调用compact_index从索引中真正删除，不支持删除的索引类型(如HNSW)
+   则从特征向量库重建索引
 """
+import itertools
 import os
-import faiss
-from model_backend import read_dicom_dir, load_model, get_feature_vector
-from read_dicom import read_specific_tags
-from tempfile import TemporaryDirectory
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from read_dicom import read_specific_tags, tags2slice_position, sort_by_slice_position, SLICE_POSITION_TAGS
+from index_manager import index_manager, create_index, add_batches, train_index, remove_ids, search_index
+from vector_store import FeatureVectorStore
+from utils import ZipArchiveCache
 from config import *
 from loguru import logger
-import shutil
 import numpy as np
 from tqdm import tqdm
 
 
-def build_from_dir(target_dir, tomography_type):
+def iter_series_files(description_objs):
+    """
+    依次查询每个Series的所有Dicom文件路径
+    生成器在流水线的读取线程中执行，因此在内部创建自己的session
+    路径按扫描标签时记录的SlicePosition排序，与检索时读取切片的顺序一致；旧数据没有SlicePosition时从文件头计算
+    :return: 生成器，每次产出(IndexID, file_paths)
+    """
+    with read_session() as query_session:
+        for obj in description_objs:
+            saving_objs = query_session.query(DicomFileSavingPath).filter(
+                DicomFileSavingPath.SeriesInstanceUID == obj.SeriesInstanceUID).order_by(
+                DicomFileSavingPath.SlicePosition, DicomFileSavingPath.InstanceNumber).all()
+            file_paths = [saving_obj.RelativePath for saving_obj in saving_objs]
+            if any(saving_obj.SlicePosition is None for saving_obj in saving_objs):
+                file_paths = sort_by_slice_position(file_paths)
+            yield int(obj.IndexID), file_paths
+
+
+# 建库时扫描的标签：描述表和路径表需要的标签，以及计算切片位置需要的标签
+_SCAN_TAGS = list(need_tags.keys()) + [tag for tag in SLICE_POSITION_TAGS if tag not in need_tags]
+
+
+def _read_tags_chunk(files):
+    """
+    在子进程中读取一组文件的标签
+    :return: [(file, {tag: value}), ...]
+    """
+    return [(file, read_specific_tags(file, _SCAN_TAGS, stop_early=True)) for file in files]
+
+
+def scan_dicom_tags(target_dcm_files, workers: int = None, chunksize: int = None):
+    """
+    使用进程池并行读取所有dcm文件的标签，文件按chunksize分块提交，减少进程间通信次数
+    :param workers: 进程数，默认使用pipeline_config中的scan_workers，为None时使用全部CPU核心，为1时在当前进程中串行读取
+    :return: (descriptions_dict, savings)，descriptions_dict: {SeriesInstanceUID: 描述表字段}，
+             savings: {SeriesInstanceUID-InstanceNumber: (文件路径, 切片位置)}
+    """
+    workers = workers or pipeline_config['scan_workers'] or os.cpu_count()
+    chunksize = chunksize or pipeline_config['scan_chunksize']
+    # 文件较少时减小分块，保证每个进程都能分到任务
+    chunksize = max(1, min(chunksize, len(target_dcm_files) // (workers * 4)))
+    chunks = [target_dcm_files[i:i + chunksize] for i in range(0, len(target_dcm_files), chunksize)]
+    # 利用字典key唯一特性，保存SeriesID到内存，同时保存文件相对路径
+    descriptions_dict = {}
+    savings = {}
+    progress = tqdm(total=len(target_dcm_files))
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    try:
+        chunk_results = executor.map(_read_tags_chunk, chunks) if executor else map(_read_tags_chunk, chunks)
+        for chunk_result in chunk_results:
+            for file, temp_tags_dict in chunk_result:
+                # temp_tags_dict: {tag: value}  need_tags: {tag: description}
+                descriptions_dict[temp_tags_dict['0020|000e']] = {
+                    need_tags['0020|000e']: temp_tags_dict['0020|000e'],
+                    need_tags['0010|0010']: temp_tags_dict['0010|0010'],
+                    need_tags['0010|0040']: temp_tags_dict['0010|0040'],
+                    need_tags['0010|0030']: temp_tags_dict['0010|0030'],
+                    need_tags['0010|1010']: temp_tags_dict['0010|1010'],
+                    need_tags['0020|0012']: temp_tags_dict['0020|0012'],
+                    need_tags['0018|1030']: temp_tags_dict['0018|1030'],
+                    need_tags['0008|0020']: temp_tags_dict['0008|0020'],
+                    need_tags['0008|0030']: temp_tags_dict['0008|0030'],
+                    need_tags['0008|0080']: temp_tags_dict['0008|0080']
+                }
+                savings[f"{temp_tags_dict['0020|000e']}-{temp_tags_dict['0020|0013']}"] = (
+                    file, tags2slice_position(temp_tags_dict))
+            progress.update(len(chunk_result))
+    finally:
+        if executor:
+            executor.shutdown()
+        progress.close()
+    return descriptions_dict, savings
+
+
+def _chunked(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def bulk_insert_records(DescriptionObj, descriptions_dict, savings, batch_size: int = None):
+    """
+    在一个事务中按批次插入路径表和描述表的数据行，已存在的行通过ON CONFLICT DO NOTHING跳过
+    :return: 本次新插入的描述对象列表(包含自增的IndexID)，供后续计算特征向量使用
+    """
+    batch_size = batch_size or pipeline_config['insert_batch_size']
+    saving_rows = []
+    for id, (path, position) in savings.items():
+        series_id, instance_number = id.rsplit('-', 1)
+        saving_rows.append({'SeriesSequenceID': id, 'RelativePath': path, 'SeriesInstanceUID': series_id,
+                            'InstanceNumber': int(instance_number) if instance_number.isdigit() else None,
+                            'SlicePosition': position})
+    description_rows = list(descriptions_dict.values())
+    new_series_ids = []
+    # 新增了文件的Series，启用压缩包缓存时才需要统计
+    grown_series_ids = set()
+    with meta_session() as session:
+        saving_stmt = sqlite_insert(DicomFileSavingPath).on_conflict_do_nothing()
+        for rows in _chunked(saving_rows, batch_size):
+            if zip_cache is not None:
+                existing_sequence_ids = set()
+                for ids in _chunked([row['SeriesSequenceID'] for row in rows], 500):
+                    query = session.query(DicomFileSavingPath.SeriesSequenceID).filter(
+                        DicomFileSavingPath.SeriesSequenceID.in_(ids))
+                    existing_sequence_ids.update(sequence_id for sequence_id, in query)
+                grown_series_ids.update(row['SeriesInstanceUID'] for row in rows
+                                        if row['SeriesSequenceID'] not in existing_sequence_ids)
+            session.execute(saving_stmt, rows)
+        description_stmt = sqlite_insert(DescriptionObj).on_conflict_do_nothing()
+        for rows in _chunked(description_rows, batch_size):
+            # 在同一事务中先查询已存在的SeriesID，剩余的即为本次新插入的Series
+            series_ids = [row['SeriesInstanceUID'] for row in rows]
+            existing_ids = set()
+            for ids in _chunked(series_ids, 500):
+                query = session.query(DescriptionObj.SeriesInstanceUID).filter(
+                    DescriptionObj.SeriesInstanceUID.in_(ids))
+                existing_ids.update(series_id for series_id, in query)
+            session.execute(description_stmt, rows)
+            new_series_ids.extend(series_id for series_id in series_ids if series_id not in existing_ids)
+        session.commit()
+        if zip_cache is not None:
+            # 已存在的Series新增了文件时其压缩包缓存失效；新插入的Series不可能有缓存，删除时已经discard过
+            for series_id in grown_series_ids - set(new_series_ids):
+                zip_cache.discard(series_id)
+        logger.info(f'路径表共{len(saving_rows)}行，描述表新插入{len(new_series_ids)}行，'
+                    f'跳过已存在的Series {len(description_rows) - len(new_series_ids)} 个')
+        new_objs = []
+        for ids in _chunked(new_series_ids, 500):
+            new_objs.extend(session.query(DescriptionObj).filter(DescriptionObj.SeriesInstanceUID.in_(ids)).all())
+    return new_objs
+
+
+def build_from_dir(target_dir, tomography_type, scan_workers: int = None):
     if tomography_type == 'LumbarDisc':
         DescriptionObj = LumbarDiscDescription
         index_file = type_config[tomography_type]['index_file']
-        feature_vector_length = type_config[tomography_type]['feature_vector_length']
         logger.info(f'断层扫描类型为：{tomography_type}')
     else:
         raise ValueError('The file_type parameter must be LumbarDisc')
-    # 如果Faiss索引文件存在，则直接读取索引文件，否则生成新索引
-    logger.info("正在检查索引文件...")
-    if os.path.exists(index_file):
-        index = faiss.read_index(index_file)
-    else:
-        index = faiss.IndexFlatL2(feature_vector_length)
-        index = faiss.IndexIDMap(index)
     # 连接数据库，创建engine，创建表，并创建绑定session类
     logger.info("正在连接数据库...")
     # 获取目标目录下所有dcm文件的路径
@@ -45,201 +175,318 @@ def build_from_dir(target_dir, tomography_type):
     for file in os.listdir(target_dir):
         if os.path.splitext(file)[-1] == '.dcm':
             target_dcm_files.append(os.path.join(target_dir, file))
-    # 利用字典key唯一特性，保存SeriesID到内存，同时保存文件相对路径
-    descriptions_dict = {}
-    savings = {}
     logger.info("开始读取Dicom文件标签...")
-    for file in tqdm(target_dcm_files):
-        # temp_tags_dict: {tag: value}  need_tags: {tag: description}
-        temp_tags_dict = read_specific_tags(file, list(need_tags.keys()))
-        descriptions_dict[temp_tags_dict['0020|000e']] = {
-            need_tags['0020|000e']: temp_tags_dict['0020|000e'],
-            need_tags['0010|0010']: temp_tags_dict['0010|0010'],
-            need_tags['0010|0040']: temp_tags_dict['0010|0040'],
-            need_tags['0010|0030']: temp_tags_dict['0010|0030'],
-            need_tags['0010|1010']: temp_tags_dict['0010|1010'],
-            need_tags['0020|0012']: temp_tags_dict['0020|0012'],
-            need_tags['0018|1030']: temp_tags_dict['0018|1030'],
-            need_tags['0008|0020']: temp_tags_dict['0008|0020'],
-            need_tags['0008|0030']: temp_tags_dict['0008|0030'],
-            need_tags['0008|0080']: temp_tags_dict['0008|0080']
-        }
-        savings[f"{temp_tags_dict['0020|000e']}-{temp_tags_dict['0020|0013']}"] = file
+    descriptions_dict, savings = scan_dicom_tags(target_dcm_files, scan_workers)
     logger.info("正在将信息插入数据库...")
-    # 将所有路径对象存入列表，并创建session添加所有对象到表中
-    saving_objs = []
-    for id, path in savings.items():
-        saving_objs.append(DicomFileSavingPath(SeriesSequenceID=id, RelativePath=path))
-    with meta_session() as saving_session:
-        for saving_obj in saving_objs:
-            try:
-                saving_session.add(saving_obj)
-                saving_session.commit()
-            except Exception as e:
-                logger.error(f'插入 {saving_obj.SeriesSequenceID} 时出错：{e}')
-                saving_session.rollback()
-                continue
+    description_insert_success = bulk_insert_records(DescriptionObj, descriptions_dict, savings)
 
-    # 将所有描述对象存入列表，并创建session添加所有对象到表中, 保存成功的对象添加到列表准备下一步工作
-    description_objs = []
-    for value in descriptions_dict.values():
-        description_objs.append(DescriptionObj(**value))
-    description_insert_success = []
-    with meta_session() as description_session:
-        for description_obj in description_objs:
-            try:
-                description_session.add(description_obj)
-                description_session.commit()
-                description_insert_success.append(description_obj)
-            except Exception as e:
-                logger.error(f'Insert {description_obj.SeriesInstanceUID} failed! Because {e}')
-                description_session.rollback()
-                continue
-
-        # 装载深度学习模型，为获取特征向量做准备
-        if description_insert_success:
-            logger.info("有新信息插入，开始载入模型，计算特征向量...")
-            model = load_model(tomography_type)
-            with meta_session() as query_session:
-                # 开始对保存成功的Series信息进行循环，准备计算特征向量
-                feature_vectors = []
-                index_ids = []
-                for obj in tqdm(description_insert_success):
-                    # 获取所有的路径表主键
-                    primary_keys = [f"{obj.SeriesInstanceUID}-{i}" for i in range(1, int(obj.AcquisitionNumber) + 1)]
-                    with TemporaryDirectory() as tmpdir:
-                        # 复制一个Series的dicom文件到临时目录
-                        for primary_key in primary_keys:
-                            file_path = query_session.query(DicomFileSavingPath).get(primary_key).RelativePath
-                            shutil.copyfile(file_path, os.path.join(tmpdir, os.path.split(file_path)[-1]))
-                        # 开始进行特征提取
-                        image_array = read_dicom_dir(tmpdir)
-                        feature_vector = get_feature_vector(model, image_array)
-                        feature_vectors.append(feature_vector)
-                        index_ids.append(int(query_session.query(DescriptionObj).filter(
-                            DescriptionObj.SeriesInstanceUID == obj.SeriesInstanceUID).first().IndexID))
+    # 装载深度学习模型，为获取特征向量做准备
+    if description_insert_success:
+        # SQLite可能复用已删除的最大IndexID，先压缩索引，真正删除这些ID对应的旧向量并清除其墓碑
+        # 需要在打开特征向量库之前进行：压缩退回重建时会整理向量库，新插入的Series不参与重建，只在下面写入索引
+        new_ids = {obj.IndexID for obj in description_insert_success}
+        if index_manager.tombstones(tomography_type) & new_ids:
+            compact_index(tomography_type, exclude_ids=new_ids)
+        logger.info("有新信息插入，开始载入模型，计算特征向量...")
+        from model_backend import load_model
+        from pipeline import FeaturePipeline
+        model = load_model(tomography_type)
+        batch_size = type_config[tomography_type]['batch_size']
+        # 将保存成功的Series送入流水线，读取、预处理和推理并行进行，按批次添加到索引
+        feature_pipeline = FeaturePipeline(model, batch_size)
+        series_files = iter_series_files(description_insert_success)
+        total = len(description_insert_success)
+        # 计算出的特征向量同时追加到特征向量库，之后重建索引时无需再次推理
+        batches = FeatureVectorStore(tomography_type).record(feature_pipeline.run(series_files, total=total))
+        # 已有索引时新向量只写入一个增量段，耗时与新增数据量成正比；已有索引沿用其原本的索引类型，
+        # 修改index_factory后需要调用rebuild_index_from_database重建
+        if os.path.exists(index_file):
+            ids_arrays, features_arrays = [], []
+            for ids_array, features_array in batches:
+                ids_arrays.append(ids_array)
+                features_arrays.append(features_array)
+            if not ids_arrays:
+                logger.warning('没有成功计算出特征向量的Series，不写入增量段')
+            else:
+                segment_count, delta_rows = index_manager.append_segment(tomography_type, np.concatenate(ids_arrays),
+                                                                         np.concatenate(features_arrays))
+                if segment_count >= type_config[tomography_type]['max_delta_segments'] or \
+                        delta_rows >= type_config[tomography_type]['max_delta_rows']:
+                    logger.info(f'增量段共{segment_count}个、{delta_rows}条向量，达到上限，在后台合并到基础索引...')
+                    threading.Thread(target=compact_index, args=(tomography_type,)).start()
+        else:
+            index = create_index(tomography_type)
+            if not add_batches(index, batches, type_config[tomography_type]['train_size']):
+                logger.warning('没有成功计算出特征向量的Series，不创建索引文件')
+            else:
                 logger.info("正在保存最终文件...")
-                features_array = np.concatenate(feature_vectors).astype('float32')
-                ids_array = np.array(index_ids).astype('int64')
-                index.add_with_ids(features_array, ids_array)
-                faiss.write_index(index, index_file)
+                index_manager.publish(tomography_type, index)
     logger.success(f'建库流程完成！共插入新数据{len(description_insert_success)}条！')
 
 
-def rebuild_index_from_database(tomography_type):
+def rebuild_index_from_database(tomography_type, exclude_ids=None):
+    """
+    根据数据库中现有的所有Series重建索引，用于删除数据或修改index_factory之后
+    特征向量库中已有的向量直接读取，只有向量库中没有的Series(或模型更新后的所有Series)才会重新推理
+    :param exclude_ids: 不参与重建的IndexID，如增量建库中刚插入、随后会单独写入索引的Series
+    """
     if tomography_type == 'LumbarDisc':
         DescriptionObj = LumbarDiscDescription
-        index_file = type_config[tomography_type]['index_file']
-        feature_vector_length = type_config[tomography_type]['feature_vector_length']
     else:
         raise ValueError('The file_type parameter must be LumbarDisc')
-    logger.info('正在建立索引对象...')
-    index = faiss.IndexFlatL2(feature_vector_length)
-    index = faiss.IndexIDMap(index)
-    logger.info('正在加载深度学习模型...')
-    model = load_model(tomography_type)
+    logger.info(f"正在建立索引对象，索引类型为{type_config[tomography_type]['index_factory']}...")
+    index = create_index(tomography_type)
+    train_size = type_config[tomography_type]['train_size']
+    # 在查询数据库之前记录墓碑和增量段，墓碑中的IndexID已经从数据库删除，不会出现在新索引中，
+    # 增量段中的Series已经写入数据库，会包含在新索引中，发布后即可清除
+    deleted_ids = index_manager.tombstones(tomography_type)
+    merged_segments = index_manager.segment_names(tomography_type)
     logger.info("正在连接数据库...")
-    logger.info('开始从数据库重建特征向量索引...')
-    with meta_session() as query_session:
-        # 开始对所有Series信息进行循环，准备计算特征向量
+    with read_session() as query_session:
         all_description_objs = query_session.query(DescriptionObj).all()
-        feature_vectors = []
-        index_ids = []
-        for obj in tqdm(all_description_objs):
-            # 获取所有的路径表主键
-            primary_keys = [f"{obj.SeriesInstanceUID}-{i}" for i in range(1, int(obj.AcquisitionNumber) + 1)]
-            with TemporaryDirectory() as tmpdir:
-                # 复制一个Series的dicom文件到临时目录
-                for primary_key in primary_keys:
-                    file_path = query_session.query(DicomFileSavingPath).get(primary_key).RelativePath
-                    shutil.copyfile(file_path, os.path.join(tmpdir, os.path.split(file_path)[-1]))
-                # 开始进行特征提取
-                image_array = read_dicom_dir(tmpdir)
-                feature_vector = get_feature_vector(model, image_array)
-                feature_vectors.append(feature_vector)
-                index_ids.append(int(query_session.query(DescriptionObj).filter(
-                    DescriptionObj.SeriesInstanceUID == obj.SeriesInstanceUID).first().IndexID))
-        logger.info("正在保存最终文件...")
-        features_array = np.concatenate(feature_vectors).astype('float32')
-        ids_array = np.array(index_ids).astype('int64')
-        index.add_with_ids(features_array, ids_array)
-        faiss.write_index(index, index_file)
-        logger.success(f'重建特征向量索引完成！共建立新索引{len(all_description_objs)}条！')
+    if exclude_ids:
+        all_description_objs = [obj for obj in all_description_objs if obj.IndexID not in exclude_ids]
+    live_ids = np.array([obj.IndexID for obj in all_description_objs], dtype='int64')
+    logger.info('正在读取特征向量库...')
+    vector_store = FeatureVectorStore(tomography_type)
+    keep_mask = vector_store.latest_mask(live_ids)
+    # 清理已删除和重复的向量，之后向量库中的每一行都对应一个现有的Series
+    if not keep_mask.all():
+        vector_store.compact(keep_mask)
+    stored_ids, stored_vectors = vector_store.load()
+    logger.info(f'特征向量库中已有{len(stored_ids)}个Series的特征向量，'
+                f'需要重新推理{len(live_ids) - len(stored_ids)}个')
+    # 向量库足够大时，从中随机抽样训练索引，否则在添加时使用最先到达的向量训练
+    if not index.is_trained and len(stored_ids) >= train_size:
+        sample_rows = np.sort(np.random.default_rng().choice(len(stored_ids), train_size, replace=False))
+        train_index(index, stored_vectors[sample_rows])
+    batches = vector_store.iter_batches()
+    stored_id_set = set(stored_ids.tolist())
+    missing_objs = [obj for obj in all_description_objs if obj.IndexID not in stored_id_set]
+    if missing_objs:
+        logger.info('正在加载深度学习模型...')
+        from model_backend import load_model
+        from pipeline import FeaturePipeline
+        model = load_model(tomography_type)
+        # 将向量库中没有的Series送入流水线，读取、预处理和推理并行进行，结果同时追加到向量库
+        feature_pipeline = FeaturePipeline(model, type_config[tomography_type]['batch_size'])
+        series_files = iter_series_files(missing_objs)
+        batches = itertools.chain(batches, vector_store.record(feature_pipeline.run(series_files,
+                                                                                    total=len(missing_objs))))
+    logger.info('开始重建特征向量索引...')
+    add_batches(index, batches, train_size)
+    logger.info("正在保存最终文件...")
+    index_manager.publish(tomography_type, index, cleared_tombstones=deleted_ids, merged_segments=merged_segments)
+    logger.success(f'重建特征向量索引完成！共建立新索引{index.ntotal}条！')
 
 
 def delete_by_series_id(series_ids, tomography_type):
+    """
+    删除数据库记录，并将其IndexID记录为墓碑，之后的检索结果中立即不再出现这些Series
+    墓碑数量超过max_tombstones时自动调用compact_index
+    """
     if tomography_type == 'LumbarDisc':
         DescriptionObj = LumbarDiscDescription
     else:
         raise ValueError('The file_type parameter must be LumbarDisc')
+    deleted_ids = []
     with meta_session() as session:
         for series_id in series_ids:
             try:
                 target_obj = session.query(DescriptionObj).filter(DescriptionObj.SeriesInstanceUID == series_id).first()
-                path_obj_ids = [f"{target_obj.SeriesInstanceUID}-{i}" for i in
-                                range(1, int(target_obj.AcquisitionNumber) + 1)]
-                for path_obj_id in path_obj_ids:
-                    record = session.query(DicomFileSavingPath).get(path_obj_id)
-                    session.delete(record)
+                session.query(DicomFileSavingPath).filter(
+                    DicomFileSavingPath.SeriesInstanceUID == target_obj.SeriesInstanceUID).delete()
                 session.delete(target_obj)
                 session.commit()
+                description_cache.discard(tomography_type, [target_obj.IndexID])
+                if zip_cache is not None:
+                    zip_cache.discard(series_id)
+                deleted_ids.append(target_obj.IndexID)
             except Exception as e:
                 logger.error(f"当删除SeriesID为{series_id}的对象时发生错误: {e}")
                 session.rollback()
                 continue
+    if deleted_ids and os.path.exists(type_config[tomography_type]['index_file']):
+        tombstone_count = index_manager.add_tombstones(tomography_type, deleted_ids)
+        if tombstone_count >= type_config[tomography_type]['max_tombstones']:
+            compact_index(tomography_type)
+
+
+_compact_lock = threading.Lock()
+
+
+def compact_index(tomography_type, exclude_ids=None):
+    """
+    将所有增量段合并到基础索引，并将墓碑中的IndexID从索引中真正删除后保存，索引类型不支持删除时从特征向量库重建索引
+    合并和删除在基础索引的副本上进行，不影响正在使用当前索引的检索
+    :param exclude_ids: 退回重建索引时不参与重建的IndexID，见rebuild_index_from_database
+    """
+    with _compact_lock:
+        deleted_ids = index_manager.tombstones(tomography_type)
+        segmented_index = index_manager.get(tomography_type)
+        if segmented_index is None or not (deleted_ids or segmented_index.deltas):
+            return
+        merged_segments = list(segmented_index.deltas)
+        logger.info(f'正在压缩{tomography_type}索引：合并{len(merged_segments)}个增量段，删除{len(deleted_ids)}个IndexID...')
+        index = segmented_index.merged()
+        if deleted_ids and not remove_ids(index, deleted_ids):
+            logger.info('索引类型不支持删除，从特征向量库重建索引')
+            rebuild_index_from_database(tomography_type, exclude_ids)
+            return
+        index_manager.publish(tomography_type, index, cleared_tombstones=deleted_ids, merged_segments=merged_segments)
+        logger.success(f'{tomography_type}索引压缩完成，共{index.ntotal}条向量')
+
+
+class DescriptionCache:
+    """
+    按(tomography_type, IndexID)缓存热点描述表记录的LRU缓存，容量为0时不缓存
+    SQLite会复用已删除的最大IndexID，检索使用的索引发生变化后(可能是其他进程删除、压缩或增量建库)，
+    该类型的缓存全部失效，避免复用的IndexID返回已删除Series的记录
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._records = OrderedDict()
+        # tomography_type -> 缓存记录对应的索引状态
+        self._index_stamps = {}
+        self._lock = threading.Lock()
+
+    def validate(self, tomography_type, index_stamp):
+        """
+        索引状态与缓存记录对应的状态不同时，清除该类型的所有缓存记录
+        """
+        if self._index_stamps.get(tomography_type) == index_stamp:
+            return
+        with self._lock:
+            if self._index_stamps.get(tomography_type) != index_stamp:
+                for key in [key for key in self._records if key[0] == tomography_type]:
+                    del self._records[key]
+                self._index_stamps[tomography_type] = index_stamp
+
+    def get_many(self, tomography_type, index_ids):
+        found = {}
+        if not self.max_size:
+            return found
+        with self._lock:
+            for index_id in index_ids:
+                record = self._records.get((tomography_type, index_id))
+                if record is not None:
+                    self._records.move_to_end((tomography_type, index_id))
+                    found[index_id] = record
+        return found
+
+    def put_many(self, tomography_type, records):
+        if not self.max_size:
+            return
+        with self._lock:
+            for record in records:
+                self._records[(tomography_type, record.IndexID)] = record
+                self._records.move_to_end((tomography_type, record.IndexID))
+            while len(self._records) > self.max_size:
+                self._records.popitem(last=False)
+
+    def discard(self, tomography_type, index_ids):
+        with self._lock:
+            for index_id in index_ids:
+                self._records.pop((tomography_type, index_id), None)
+
+
+description_cache = DescriptionCache(serve_config['description_cache_size'])
+
+# 下载压缩包的磁盘缓存，未配置缓存目录时为None；缓存在磁盘上，建库和删除进程可以直接使其失效
+zip_cache = None
+if serve_config['zip_cache_dir']:
+    zip_cache = ZipArchiveCache(serve_config['zip_cache_dir'], serve_config['zip_cache_max_bytes'])
 
 
-def query_by_index_id(index_ids, tomography_type):
+def query_by_index_id(index_ids, tomography_type, return_missing: bool = False):
+    """
+    使用一条IN查询批量获取描述记录，结果保持index_ids的顺序，负数ID(Faiss的空结果)会被忽略
+    :param return_missing: 为True时返回(results, missing_ids)
+    """
     if tomography_type == 'LumbarDisc':
         DescriptionObj = LumbarDiscDescription
     else:
         raise ValueError('The file_type parameter must be LumbarDisc')
-    with meta_session() as session:
-        results = []
-        for index_id in index_ids:
-            result = session.query(DescriptionObj).get(int(index_id))
-            if result:
-                results.append(result)
-            else:
-                logger.error(f'未查询到Index ID为{index_id}的记录')
-        return results
+    index_ids = [int(index_id) for index_id in index_ids if int(index_id) >= 0]
+    records = description_cache.get_many(tomography_type, index_ids)
+    query_ids = [index_id for index_id in index_ids if index_id not in records]
+    if query_ids:
+        with read_session() as session:
+            query_results = session.query(DescriptionObj).filter(DescriptionObj.IndexID.in_(query_ids)).all()
+        description_cache.put_many(tomography_type, query_results)
+        records.update({record.IndexID: record for record in query_results})
+    results = []
+    missing_ids = []
+    for index_id in index_ids:
+        if index_id in records:
+            results.append(records[index_id])
+        else:
+            missing_ids.append(index_id)
+    if missing_ids:
+        logger.error(f'未查询到Index ID为{missing_ids}的记录')
+    if return_missing:
+        return results, missing_ids
+    return results
 
 
 def query_saving_path_by_series_id(series_id):
-    with meta_session() as session:
+    with read_session() as session:
         query_results = session.query(DicomFileSavingPath).filter(
-            DicomFileSavingPath.SeriesSequenceID.like(series_id + "%")).all()
+            DicomFileSavingPath.SeriesInstanceUID == series_id).order_by(DicomFileSavingPath.InstanceNumber).all()
         saving_paths = []
         for result in query_results:
             saving_paths.append(result.RelativePath)
         return saving_paths
 
 
-def search_similar_topn(feature_vector: np.ndarray, top_number: int, tomography_type):
+def search_similar_topn(feature_vector: np.ndarray, top_number: int, tomography_type, search_effort: int = None):
     if tomography_type == 'LumbarDisc':
-        index_file = type_config[tomography_type]['index_file']
         feature_vector_length = type_config[tomography_type]['feature_vector_length']
     else:
         raise ValueError('The file_type parameter must be LumbarDisc')
-    if not os.path.exists(index_file):
-        logger.error('配置指定的Faiss索引文件不存在，无法加载索引文件！')
-        return None
     if feature_vector.shape != (1, feature_vector_length):
         logger.error(f'查询{tomography_type}的向量长度不符合要求,应为{(1, feature_vector_length)}')
         return None
+    results = search_similar_topn_batch(feature_vector, top_number, tomography_type, search_effort)
+    return results[0] if results is not None else None
+
+
+def search_similar_topn_batch(feature_vectors: np.ndarray, top_number: int, tomography_type,
+                              search_effort: int = None):
+    """
+    将多个查询向量通过一次index.search检索，并用一次数据库查询取回所有命中的记录
+    :param feature_vectors: (N, feature_vector_length)的查询向量
+    :param search_effort: 本次检索的范围(IVF为nprobe，HNSW为efSearch)，为None时使用type_config中的默认值
+    :return: 长度为N的列表，每个元素为按距离排序的SearchResult列表
+    """
+    if tomography_type == 'LumbarDisc':
+        feature_vector_length = type_config[tomography_type]['feature_vector_length']
+    else:
+        raise ValueError('The file_type parameter must be LumbarDisc')
+    if feature_vectors.ndim != 2 or feature_vectors.shape[1] != feature_vector_length:
+        logger.error(f'查询{tomography_type}的向量长度不符合要求,应为{(-1, feature_vector_length)}')
+        return None
     if top_number < 1 or top_number > 20:
         logger.error("寻找相似向量范围不能为负数或大于20！")
         return None
-    index = faiss.read_index(index_file)
-    search_result = index.search(feature_vector.astype('float32'), top_number)
-    search_result_dict = {}
-    for i in range(top_number):
-        search_result_dict[str(search_result[1][0][i])] = search_result[0][0][i]
-    search_result_objs = []
-    match_records = query_by_index_id(list(search_result_dict.keys()), tomography_type)
-    for record in match_records:
-        search_result_objs.append(SearchResult(SeriesRecord=record, Distance=search_result_dict[str(record.IndexID)]))
-    return sorted(search_result_objs)
+    index = index_manager.get(tomography_type)
+    if index is None:
+        logger.error('配置指定的Faiss索引文件不存在，无法加载索引文件！')
+        return None
+    description_cache.validate(tomography_type, index_manager.stamp(tomography_type))
+    distances, ids = search_index(index, np.ascontiguousarray(feature_vectors, dtype='float32'), top_number,
+                                  search_effort, exclude_ids=index_manager.tombstones(tomography_type))
+    match_records = query_by_index_id(np.unique(ids[ids >= 0]).tolist(), tomography_type)
+    records = {record.IndexID: record for record in match_records}
+    results = []
+    for query_distances, query_ids in zip(distances, ids):
+        search_result_objs = []
+        for distance, index_id in zip(query_distances, query_ids):
+            if int(index_id) in records:
+                search_result_objs.append(SearchResult(SeriesRecord=records[int(index_id)], Distance=distance))
+        results.append(sorted(search_result_objs))
+    return results
 
 
 if __name__ == '__main__':
@@ -0,0 +1,129 @@
+"""
+紧凑的Dicom数据字典：
+description.py中的DicomDictionary是一个约490KB的字典字面量，导入时需要构造近5000个元组，
+而服务端只在解析隐式VR和输出标签描述时按标签查询其中少量条目
+本模块在首次查询时才加载字典，使用排好序的标签数组、记录偏移数组和一段UTF-8记录文本表示，二分查找定位记录；
+紧凑表示缓存为__pycache__下的npz文件(类似pyc)，description.py变化后自动重新生成
+"""
+import importlib.util
+import os
+import threading
+from functools import lru_cache
+import numpy as np
+
+_SOURCE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'description.py')
+# 与description.py的pyc放在同一目录，同样遵循PYTHONPYCACHEPREFIX
+_CACHE_FILE = os.path.splitext(importlib.util.cache_from_source(_SOURCE_FILE))[0] + '.dictionary.npz'
+# 记录中各字段的分隔符，字典中的字段都不包含该字符
+_FIELD_SEPARATOR = '\t'
+
+
+class CompactDicomDictionary:
+    def __init__(self, tags, offsets, records: bytes):
+        """
+        :param tags: 排好序的标签数组(uint32)
+        :param offsets: 每条记录在records中的起始偏移，长度为len(tags) + 1
+        :param records: 所有记录拼接成的UTF-8文本，每条记录为以制表符分隔的(VR, VM, 名称, 是否废弃, 关键字)
+        """
+        self._tags = tags
+        self._offsets = offsets
+        self._records = records
+
+    @classmethod
+    def from_dict(cls, dictionary):
+        tags = np.array(sorted(dictionary), dtype='uint32')
+        records = [_FIELD_SEPARATOR.join(dictionary[tag]).encode('utf-8') for tag in tags.tolist()]
+        offsets = np.zeros(len(records) + 1, dtype='int64')
+        offsets[1:] = np.cumsum([len(record) for record in records])
+        return cls(tags, offsets, b''.join(records))
+
+    def __len__(self):
+        return len(self._tags)
+
+    def __contains__(self, tag):
+        return self.get(tag) is not None
+
+    def get(self, tag: int, default=None):
+        position = int(np.searchsorted(self._tags, tag))
+        if position == len(self._tags) or self._tags[position] != tag:
+            return default
+        record = self._records[self._offsets[position]:self._offsets[position + 1]]
+        return tuple(record.decode('utf-8').split(_FIELD_SEPARATOR))
+
+    def items(self):
+        for position, tag in enumerate(self._tags.tolist()):
+            record = self._records[self._offsets[position]:self._offsets[position + 1]]
+            yield tag, tuple(record.decode('utf-8').split(_FIELD_SEPARATOR))
+
+    def save(self, path):
+        tmp_file = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, tags=self._tags, offsets=self._offsets, records=np.frombuffer(self._records, dtype='uint8'),
+                     source_stamp=_source_stamp())
+        os.replace(tmp_file, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        读取缓存的紧凑表示，缓存不存在或description.py已变化时返回None
+        """
+        try:
+            with np.load(path) as data:
+                if not np.array_equal(data['source_stamp'], _source_stamp()):
+                    return None
+                return cls(data['tags'], data['offsets'], data['records'].tobytes())
+        except (OSError, KeyError, ValueError):
+            return None
+
+
+def _source_stamp():
+    stat = os.stat(_SOURCE_FILE)
+    return np.array([stat.st_mtime_ns, stat.st_size], dtype='int64')
+
+
+_dictionary = None
+_keyword_index = None
+_dictionary_lock = threading.Lock()
+
+
+def get_dicom_dictionary():
+    """
+    获取紧凑的Dicom数据字典，首次调用时优先读取缓存，缓存失效时从description.py生成并写入缓存
+    """
+    global _dictionary
+    if _dictionary is None:
+        with _dictionary_lock:
+            if _dictionary is None:
+                dictionary = CompactDicomDictionary.load(_CACHE_FILE)
+                if dictionary is None:
+                    from description import DicomDictionary
+                    dictionary = CompactDicomDictionary.from_dict(DicomDictionary)
+                    try:
+                        os.makedirs(os.path.dirname(_CACHE_FILE), exist_ok=True)
+                        dictionary.save(_CACHE_FILE)
+                    except OSError:
+                        # 目录只读时不缓存，下次启动重新生成
+                        pass
+                _dictionary = dictionary
+    return _dictionary
+
+
+@lru_cache(maxsize=8192)
+def lookup_tag(tag: int):
+    """
+    :param tag: 整数形式的标签，如0x00100010
+    :return: (VR, VM, 名称, 是否废弃, 关键字)，字典中没有该标签时返回None
+    """
+    return get_dicom_dictionary().get(tag)
+
+
+def lookup_keyword(keyword: str):
+    """
+    关键字到标签的反向查询，如'PatientName' -> 0x00100010，反向索引在首次调用时建立
+    :return: 整数形式的标签，字典中没有该关键字时返回None
+    """
+    global _keyword_index
+    if _keyword_index is None:
+        keyword_index = {entry[4]: tag for tag, entry in get_dicom_dictionary().items() if entry[4]}
+        _keyword_index = keyword_index
+    return _keyword_index.get(keyword)
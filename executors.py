@@ -0,0 +1,69 @@
+"""
+在线服务中阻塞操作的分阶段执行器：
+解码(decode)、推理(inference)和数据库/索引查询(db)各自使用有界线程池执行，不阻塞asyncio事件循环，
+每个阶段同时执行和排队的任务总数有上限，超过上限时立即抛出ExecutorBusyError，由接口返回503
+SimpleITK、torch和faiss在计算时都会释放GIL，因此使用线程池即可获得并行
+"""
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from config import *
+
+
+class ExecutorBusyError(RuntimeError):
+    def __init__(self, stage):
+        super(ExecutorBusyError, self).__init__(f'{stage} stage is busy')
+        self.stage = stage
+
+
+class StageExecutor:
+    def __init__(self, name, workers: int, max_pending: int):
+        """
+        :param workers: 同时执行的任务数
+        :param max_pending: 线程全忙时允许排队等待的任务数
+        """
+        self.name = name
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f'{name}-stage')
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+
+    async def run(self, fn, *args, **kwargs):
+        return await self.run_future(self._executor.submit, functools.partial(fn, *args, **kwargs))
+
+    async def run_future(self, submit, *args, **kwargs):
+        """
+        适用于自带工作线程的组件(如推理微批处理)，submit返回concurrent.futures.Future，同样受排队上限约束
+        名额在任务真正结束时才释放：客户端断开导致等待的协程被取消时，已经开始执行的任务仍会继续执行并占用名额
+        """
+        if not self._slots.acquire(blocking=False):
+            raise ExecutorBusyError(self.name)
+        try:
+            future = submit(*args, **kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(self._release_slot)
+        return await asyncio.wrap_future(future)
+
+    def _release_slot(self, future):
+        self._slots.release()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+stage_executors = {stage: StageExecutor(stage, **stage_config) for stage, stage_config in executor_config.items()}
+
+
+async def run_in_stage(stage, fn, *args, **kwargs):
+    """
+    在指定阶段的线程池中执行阻塞函数并等待结果
+    """
+    return await stage_executors[stage].run(fn, *args, **kwargs)
+
+
+async def run_future_in_stage(stage, submit, *args, **kwargs):
+    """
+    提交到自带工作线程的组件并等待结果，占用指定阶段的排队名额
+    """
+    return await stage_executors[stage].run_future(submit, *args, **kwargs)
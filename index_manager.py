@@ -0,0 +1,537 @@
+"""
+常驻内存的Faiss索引管理：
+1. 每种断层扫描类型的索引文件只在首次使用时读取一次，之后的检索直接使用内存中的索引
+2. 索引文件总是先写入临时文件再通过os.replace原子替换，读者不会读到写了一半的索引
+3. 建库或重建索引后，新索引在内存中整体替换旧索引；其他进程写入的新文件会被后台线程加载后替换，
+   加载期间检索继续使用旧索引，不会被阻塞
+4. 索引类型由type_config中的index_factory(Faiss工厂字符串)决定，如暴力检索'Flat'、倒排'IVF4096,Flat'、
+   图索引'HNSW32'、倒排加乘积量化'IVF4096,PQ32'，需要训练的索引在添加向量前先用一部分向量训练
+5. 删除的IndexID先记录为墓碑(与索引文件同名的.deleted.npy文件)，检索时立即过滤，
+   墓碑数量超过max_tombstones后再从索引中真正删除(压缩)，避免每次删除都重写整个索引文件
+6. 索引由基础索引(index_file)和若干增量段组成，增量建库时新向量写入一个新的小增量段(.npz，加载后暴力检索)，
+   并记录到段清单(.segments.json)中，不重写基础索引；增量段超过max_delta_segments后在后台合并到基础索引
+7. 服务进程默认以只读内存映射方式打开基础索引(serve_config中的index_mmap)，多个worker共享操作系统的页缓存，
+   增加worker几乎不增加常驻内存，新worker打开索引也不需要读取整个文件；内存映射的基础索引只用于检索，
+   合并时重新完整读取索引文件
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+import faiss
+import numpy as np
+from loguru import logger
+from config import *
+
+
+def write_file_atomic(path, write):
+    """
+    调用write(临时文件路径)写入同目录下的临时文件，再原子替换目标文件，写入失败时删除临时文件
+    """
+    tmp_file = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        write(tmp_file)
+        os.replace(tmp_file, path)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def write_index_atomic(index, index_file):
+    """
+    将索引写入同目录下的临时文件，再原子替换目标文件
+    """
+    write_file_atomic(index_file, lambda tmp_file: faiss.write_index(index, tmp_file))
+
+
+def _extract_ivf(index):
+    """
+    取出IDMap或预变换(如OPQ)内部的IVF索引，不是IVF索引时返回None
+    """
+    while isinstance(index, (faiss.IndexIDMap, faiss.IndexPreTransform)):
+        index = faiss.downcast_index(index.index)
+    return index if isinstance(index, faiss.IndexIVF) else None
+
+
+def _extract_hnsw(index):
+    while isinstance(index, (faiss.IndexIDMap, faiss.IndexPreTransform)):
+        index = faiss.downcast_index(index.index)
+    return index if isinstance(index, faiss.IndexHNSW) else None
+
+
+def create_index(tomography_type):
+    """
+    按type_config中的index_factory创建空索引，IVF索引本身支持带id添加，其余索引外包一层IndexIDMap
+    """
+    config = type_config[tomography_type]
+    index = faiss.index_factory(config['feature_vector_length'], config.get('index_factory', 'Flat'))
+    if _extract_ivf(index) is None:
+        index = faiss.IndexIDMap(index)
+    apply_search_defaults(tomography_type, index)
+    return index
+
+
+def apply_search_defaults(tomography_type, index):
+    """
+    将type_config中的search_effort设置为索引的默认检索范围：IVF为nprobe，HNSW为efSearch
+    """
+    search_effort = type_config[tomography_type].get('search_effort')
+    if not search_effort:
+        return
+    ivf_index = _extract_ivf(index)
+    if ivf_index is not None:
+        ivf_index.nprobe = search_effort
+    hnsw_index = _extract_hnsw(index)
+    if hnsw_index is not None:
+        hnsw_index.hnsw.efSearch = search_effort
+
+
+def add_batches(index, batches, train_size: int):
+    """
+    将(ids_array, features_array)批次依次添加到索引
+    索引尚未训练时(IVF、PQ)，先缓存前train_size个向量作为训练样本，训练后再添加缓存的和之后的所有向量
+    :return: 添加的向量数量
+    """
+    pending = []
+    pending_count = 0
+    added = 0
+    for ids_array, features_array in batches:
+        if index.is_trained:
+            index.add_with_ids(features_array, ids_array)
+            added += len(ids_array)
+            continue
+        pending.append((ids_array, features_array))
+        pending_count += len(ids_array)
+        if pending_count >= train_size:
+            added += _train_and_add(index, pending, train_size)
+            pending = []
+    if pending:
+        added += _train_and_add(index, pending, train_size)
+    return added
+
+
+def train_index(index, features_array):
+    logger.info(f'正在使用{len(features_array)}个向量训练索引...')
+    try:
+        index.train(np.ascontiguousarray(features_array, dtype='float32'))
+    except RuntimeError as e:
+        logger.error(f'训练索引失败，训练向量数量可能少于聚类中心数量，请减小index_factory中的参数：{e}')
+        raise
+
+
+def _train_and_add(index, pending, train_size):
+    features_array = np.concatenate([features for _, features in pending])
+    if not index.is_trained:
+        train_index(index, features_array[:train_size])
+    index.add_with_ids(features_array, np.concatenate([ids for ids, _ in pending]))
+    return len(features_array)
+
+
+def remove_ids(index, ids):
+    """
+    从索引中真正删除指定的IndexID，索引类型不支持删除(如HNSW)时返回False
+    """
+    ids = np.ascontiguousarray(sorted(ids), dtype='int64')
+    try:
+        index.remove_ids(faiss.IDSelectorBatch(len(ids), faiss.swig_ptr(ids)))
+    except RuntimeError:
+        return False
+    return True
+
+
+class DeltaSegment:
+    """
+    增量段：一次增量建库新增的向量及其IndexID，使用暴力检索，合并时直接读取保存的向量
+    """
+
+    def __init__(self, ids_array, features_array):
+        self.ids_array = np.ascontiguousarray(ids_array, dtype='int64')
+        self.features_array = np.ascontiguousarray(features_array, dtype='float32')
+        self.index = faiss.IndexIDMap(faiss.IndexFlatL2(self.features_array.shape[1]))
+        self.index.add_with_ids(self.features_array, self.ids_array)
+
+    @property
+    def ntotal(self):
+        return len(self.ids_array)
+
+    def search(self, feature_vectors, top_number):
+        return self.index.search(feature_vectors, top_number)
+
+    def save(self, path):
+        def write(tmp_file):
+            # 传入文件对象，np.savez不会给临时文件名追加.npz后缀
+            with open(tmp_file, 'wb') as f:
+                np.savez(f, ids=self.ids_array, features=self.features_array)
+
+        write_file_atomic(path, write)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['ids'], data['features'])
+
+
+class SegmentedIndex:
+    """
+    基础索引加若干增量段，检索时分别检索后按距离合并
+    """
+
+    def __init__(self, base, deltas=None, mapped_file=None, mapped_stamp=None):
+        """
+        :param mapped_file: 基础索引为只读内存映射时，对应的索引文件
+        :param mapped_stamp: 映射时索引文件的状态，用于确认合并时重新读取的是同一个文件
+        """
+        self.base = base
+        # 增量段文件名 -> DeltaSegment，按写入顺序排列
+        self.deltas = deltas or OrderedDict()
+        self.mapped_file = mapped_file
+        self.mapped_stamp = mapped_stamp
+
+    def with_deltas(self, deltas):
+        return SegmentedIndex(self.base, deltas, self.mapped_file, self.mapped_stamp)
+
+    @property
+    def ntotal(self):
+        return self.base.ntotal + sum(delta.ntotal for delta in self.deltas.values())
+
+    def merged(self):
+        """
+        返回包含所有增量段向量的基础索引副本，不影响正在使用的索引
+        """
+        if self.mapped_file is None:
+            index = faiss.clone_index(self.base)
+        else:
+            # 内存映射的索引数据是只读视图，复制后也无法添加向量，需要重新完整读取同一个索引文件
+            index = faiss.read_index(self.mapped_file)
+            if _file_stamp(self.mapped_file) != self.mapped_stamp:
+                raise RuntimeError(f'{self.mapped_file}已被其他进程替换，请重新合并')
+        for delta in self.deltas.values():
+            index.add_with_ids(delta.features_array, delta.ids_array)
+        return index
+
+
+def search_index(index: SegmentedIndex, feature_vectors, top_number: int, search_effort: int = None,
+                 exclude_ids=None):
+    """
+    :param search_effort: 本次检索的范围，IVF为nprobe，HNSW为efSearch，越大召回率越高、速度越慢；
+                          为None或索引为暴力检索时使用索引的默认参数
+    :param exclude_ids: 需要从结果中过滤的IndexID(墓碑)，会多检索相应数量的结果，保证过滤后仍有top_number个
+    """
+    exclude_ids = exclude_ids or ()
+    fetch_number = top_number + len(exclude_ids)
+    results = [_search_index(index.base, feature_vectors, fetch_number, search_effort)]
+    results += [delta.search(feature_vectors, fetch_number) for delta in index.deltas.values()]
+    if len(results) == 1 and not exclude_ids:
+        return results[0]
+    distances = np.concatenate([result[0] for result in results], axis=1)
+    ids = np.concatenate([result[1] for result in results], axis=1)
+    order = np.argsort(distances, axis=1, kind='stable')
+    distances = np.take_along_axis(distances, order, axis=1)
+    ids = np.take_along_axis(ids, order, axis=1)
+    keep = ids >= 0
+    if exclude_ids:
+        keep &= ~np.isin(ids, np.fromiter(exclude_ids, dtype='int64'))
+    if len(results) > 1:
+        # 合并增量段期间，同一IndexID可能短暂同时存在于基础索引和增量段中，只保留距离最小的一个
+        for row in range(len(ids)):
+            _, first_positions = np.unique(ids[row], return_index=True)
+            unique_mask = np.zeros(ids.shape[1], dtype=bool)
+            unique_mask[first_positions] = True
+            keep[row] &= unique_mask
+    # 稳定排序把保留的结果移到每行前面，并保持原有的距离顺序
+    order = np.argsort(~keep, axis=1, kind='stable')[:, :top_number]
+    keep = np.take_along_axis(keep, order, axis=1)
+    distances = np.where(keep, np.take_along_axis(distances, order, axis=1), np.inf).astype('float32')
+    ids = np.where(keep, np.take_along_axis(ids, order, axis=1), -1)
+    return distances, ids
+
+
+def _search_index(index, feature_vectors, top_number, search_effort):
+    if search_effort:
+        params = None
+        if _extract_ivf(index) is not None and hasattr(faiss, 'SearchParametersIVF'):
+            params = faiss.SearchParametersIVF(nprobe=search_effort)
+        elif _extract_hnsw(index) is not None and hasattr(faiss, 'SearchParametersHNSW'):
+            params = faiss.SearchParametersHNSW(efSearch=search_effort)
+        if params is not None:
+            return index.search(feature_vectors, top_number, params=params)
+        # 旧版本faiss不支持按次传入检索参数，修改共享索引的参数会影响并发的检索，此时使用默认参数
+    return index.search(feature_vectors, top_number)
+
+
+def read_index_shared(index_file):
+    """
+    以只读内存映射方式读取索引，多个进程映射同一个文件时共享页缓存；
+    未开启index_mmap、当前faiss版本或索引类型不支持时完整读取
+    :return: (index, 是否为内存映射)
+    """
+    if serve_config['index_mmap']:
+        flags = getattr(faiss, 'IO_FLAG_MMAP_IFC', faiss.IO_FLAG_MMAP) | getattr(faiss, 'IO_FLAG_READ_ONLY', 0)
+        try:
+            return faiss.read_index(index_file, flags), True
+        except RuntimeError as e:
+            logger.warning(f'无法以内存映射方式读取{index_file}，改为完整读取：{e}')
+    return faiss.read_index(index_file), False
+
+
+def _file_stamp(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+def _tombstone_file(tomography_type):
+    return f"{type_config[tomography_type]['index_file']}.deleted.npy"
+
+
+def _manifest_file(tomography_type):
+    return f"{type_config[tomography_type]['index_file']}.segments.json"
+
+
+def _delta_file(tomography_type, name):
+    return os.path.join(os.path.dirname(type_config[tomography_type]['index_file']), name)
+
+
+def _read_manifest(tomography_type):
+    try:
+        with open(_manifest_file(tomography_type), 'r') as f:
+            return json.load(f)['deltas']
+    except FileNotFoundError:
+        return []
+
+
+def _delta_rows(tomography_type, name):
+    """
+    增量段中的向量数量，只读取段文件中的IndexID数组，不读取特征向量；段已被合并删除时返回0
+    """
+    try:
+        with np.load(_delta_file(tomography_type, name)) as data:
+            return len(data['ids'])
+    except FileNotFoundError:
+        return 0
+
+
+def _write_manifest(tomography_type, names):
+    def write(tmp_file):
+        with open(tmp_file, 'w') as f:
+            json.dump({'deltas': names}, f)
+
+    write_file_atomic(_manifest_file(tomography_type), write)
+
+
+def _segments_stamp(tomography_type):
+    """
+    基础索引文件和段清单文件的状态，任意一个变化都需要重新加载
+    """
+    base_stamp = _file_stamp(type_config[tomography_type]['index_file'])
+    try:
+        return base_stamp, _file_stamp(_manifest_file(tomography_type))
+    except FileNotFoundError:
+        return base_stamp, None
+
+
+class IndexManager:
+    def __init__(self, check_interval: float = 1.0):
+        """
+        :param check_interval: 检查索引文件是否被其他进程更新的最小间隔(秒)
+        """
+        self.check_interval = check_interval
+        # tomography_type -> (SegmentedIndex, segments_stamp)
+        self._indexes = {}
+        self._last_check = {}
+        self._reloading = set()
+        # tomography_type -> (已删除的IndexID集合, file_stamp)
+        self._tombstones = {}
+        self._lock = threading.Lock()
+
+    def get(self, tomography_type):
+        """
+        获取指定类型的常驻索引(SegmentedIndex)，索引文件不存在时返回None
+        """
+        entry = self._indexes.get(tomography_type)
+        if entry is None:
+            with self._lock:
+                entry = self._indexes.get(tomography_type)
+                if entry is None:
+                    index_file = type_config[tomography_type]['index_file']
+                    if not os.path.exists(index_file):
+                        return None
+                    entry = self._load(tomography_type)
+            return entry[0]
+        self._refresh_in_background(tomography_type, entry)
+        return entry[0]
+
+    def stamp(self, tomography_type):
+        """
+        当前常驻索引对应的文件状态，索引被任何进程发布、合并或追加增量段并在本进程加载后都会变化，未加载时返回None
+        """
+        entry = self._indexes.get(tomography_type)
+        return entry[1] if entry is not None else None
+
+    def publish(self, tomography_type, index, cleared_tombstones=None, merged_segments=None):
+        """
+        将新建好的基础索引原子写入磁盘，并替换内存中的索引
+        :param cleared_tombstones: 新索引中已经不包含的墓碑IndexID，发布后从墓碑中移除
+        :param merged_segments: 新索引中已经包含的增量段，发布后从段清单中移除并删除文件
+        """
+        index_file = type_config[tomography_type]['index_file']
+        write_index_atomic(index, index_file)
+        apply_search_defaults(tomography_type, index)
+        with self._lock:
+            # 先替换基础索引再更新段清单，其他进程在两步之间读到的重复向量会在检索时按IndexID去重
+            names = _read_manifest(tomography_type)
+            if merged_segments:
+                names = [name for name in names if name not in set(merged_segments)]
+                _write_manifest(tomography_type, names)
+                for name in merged_segments:
+                    if os.path.exists(_delta_file(tomography_type, name)):
+                        os.remove(_delta_file(tomography_type, name))
+            entry = self._indexes.get(tomography_type)
+            loaded = entry[0].deltas if entry is not None else {}
+            deltas = OrderedDict((name, loaded[name] if name in loaded else self._read_delta(tomography_type, name))
+                                 for name in names)
+            self._indexes[tomography_type] = (SegmentedIndex(index, deltas), _segments_stamp(tomography_type))
+            if cleared_tombstones:
+                self._write_tombstones(tomography_type, self.tombstones(tomography_type) - set(cleared_tombstones))
+
+    def append_segment(self, tomography_type, ids_array, features_array):
+        """
+        将新增向量写入一个新的增量段并加入段清单，耗时只与新增向量数量成正比
+        不需要加载基础索引，建库进程中未加载索引时也只读取各增量段的IndexID数组来统计向量数量
+        :return: (当前的增量段数量, 所有增量段的向量总数)
+        """
+        delta = DeltaSegment(ids_array, features_array)
+        name = f"{os.path.basename(type_config[tomography_type]['index_file'])}.delta.{time.time_ns()}.npz"
+        delta.save(_delta_file(tomography_type, name))
+        with self._lock:
+            names = _read_manifest(tomography_type) + [name]
+            _write_manifest(tomography_type, names)
+            entry = self._indexes.get(tomography_type)
+            loaded = entry[0].deltas if entry is not None else {}
+            if entry is not None:
+                deltas = OrderedDict(entry[0].deltas)
+                deltas[name] = delta
+                self._indexes[tomography_type] = (entry[0].with_deltas(deltas),
+                                                  _segments_stamp(tomography_type))
+        delta_rows = delta.ntotal + sum(loaded[other].ntotal if other in loaded else _delta_rows(tomography_type, other)
+                                        for other in names[:-1])
+        logger.info(f'已写入{tomography_type}的增量段{name}，共{len(ids_array)}条向量，'
+                    f'当前共{len(names)}个增量段、{delta_rows}条增量向量')
+        return len(names), delta_rows
+
+    def segment_names(self, tomography_type):
+        """
+        段清单中当前的增量段文件名
+        """
+        return _read_manifest(tomography_type)
+
+    def tombstones(self, tomography_type):
+        """
+        已删除但仍留在索引文件中的IndexID，每次调用都检查墓碑文件，其他进程的删除也会立即生效
+        """
+        tombstone_file = _tombstone_file(tomography_type)
+        try:
+            stamp = _file_stamp(tombstone_file)
+        except FileNotFoundError:
+            return frozenset()
+        entry = self._tombstones.get(tomography_type)
+        if entry is None or entry[1] != stamp:
+            entry = (frozenset(np.load(tombstone_file).tolist()), stamp)
+            self._tombstones[tomography_type] = entry
+        return entry[0]
+
+    def add_tombstones(self, tomography_type, index_ids):
+        """
+        将IndexID标记为已删除，检索时过滤
+        :return: 当前的墓碑数量
+        """
+        with self._lock:
+            tombstones = self.tombstones(tomography_type) | set(index_ids)
+            self._write_tombstones(tomography_type, tombstones)
+        return len(tombstones)
+
+    def _write_tombstones(self, tomography_type, tombstones):
+        tombstone_file = _tombstone_file(tomography_type)
+        if not tombstones:
+            if os.path.exists(tombstone_file):
+                os.remove(tombstone_file)
+            self._tombstones.pop(tomography_type, None)
+            return
+
+        def write(tmp_file):
+            with open(tmp_file, 'wb') as f:
+                np.save(f, np.array(sorted(tombstones), dtype='int64'))
+
+        write_file_atomic(tombstone_file, write)
+        self._tombstones[tomography_type] = (frozenset(tombstones), _file_stamp(tombstone_file))
+
+    def invalidate(self, tomography_type):
+        with self._lock:
+            self._indexes.pop(tomography_type, None)
+
+    def _read_delta(self, tomography_type, name):
+        return DeltaSegment.load(_delta_file(tomography_type, name))
+
+    def _read_segments(self, tomography_type, previous=None):
+        """
+        读取基础索引和段清单中的增量段，文件未变化的部分沿用previous中已加载的索引
+        读取期间增量段可能被其他进程合并并删除，此时重新读取段清单
+        """
+        for attempt in range(3):
+            stamp = _segments_stamp(tomography_type)
+            if previous is not None and previous[1][0] == stamp[0]:
+                segmented_index = previous[0]
+            else:
+                index_file = type_config[tomography_type]['index_file']
+                base, mapped = read_index_shared(index_file)
+                apply_search_defaults(tomography_type, base)
+                segmented_index = SegmentedIndex(base, mapped_file=index_file if mapped else None,
+                                                 mapped_stamp=stamp[0])
+            loaded = previous[0].deltas if previous is not None else {}
+            try:
+                deltas = OrderedDict((name, loaded[name] if name in loaded else self._read_delta(tomography_type, name))
+                                     for name in _read_manifest(tomography_type))
+            except FileNotFoundError:
+                if attempt == 2:
+                    raise
+                continue
+            return segmented_index.with_deltas(deltas), stamp
+
+    def _load(self, tomography_type):
+        entry = self._read_segments(tomography_type)
+        self._indexes[tomography_type] = entry
+        logger.info(f'已加载{tomography_type}的Faiss索引，共{entry[0].ntotal}条向量，{len(entry[0].deltas)}个增量段')
+        return entry
+
+    def _refresh_in_background(self, tomography_type, entry):
+        now = time.monotonic()
+        if now - self._last_check.get(tomography_type, 0) < self.check_interval:
+            return
+        self._last_check[tomography_type] = now
+        try:
+            stamp = _segments_stamp(tomography_type)
+        except FileNotFoundError:
+            return
+        if stamp == entry[1]:
+            return
+        with self._lock:
+            if tomography_type in self._reloading:
+                return
+            self._reloading.add(tomography_type)
+        threading.Thread(target=self._reload, args=(tomography_type, entry), daemon=True).start()
+
+    def _reload(self, tomography_type, previous):
+        try:
+            entry = self._read_segments(tomography_type, previous)
+            with self._lock:
+                self._indexes[tomography_type] = entry
+            logger.info(f'{tomography_type}的Faiss索引文件已更新，已切换到新索引，'
+                        f'共{entry[0].ntotal}条向量，{len(entry[0].deltas)}个增量段')
+        except Exception as e:
+            logger.error(f'重新加载{tomography_type}的Faiss索引时出错：{e}')
+        finally:
+            with self._lock:
+                self._reloading.discard(tomography_type)
+
+
+index_manager = IndexManager()
@@ -1,12 +1,15 @@
 import uvicorn
-from fastapi import FastAPI, File, UploadFile
-from fastapi.responses import JSONResponse, FileResponse
+import json
+import zipfile
+from typing import List
+from fastapi import FastAPI, File, Form, UploadFile
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
 from utils import *
 from data_operations import *
 from tempfile import TemporaryDirectory
 import read_dicom
 from model_backend import *
-from starlette.background import BackgroundTask
+from executors import ExecutorBusyError, run_in_stage, run_future_in_stage, stage_executors
 from fastapi.middleware.cors import CORSMiddleware
 
 app = FastAPI()
@@ -20,6 +23,27 @@ app.add_middleware(
 )
 
 
+@app.on_event("startup")
+def preload_models():
+    # 启动时加载所有类型的模型，避免首个请求承担加载耗时
+    model_registry.preload()
+    # 同时打开所有类型的索引，内存映射时只建立映射，新worker的首次检索不需要等待读取索引文件
+    for tomography_type in type_config:
+        index_manager.get(tomography_type)
+
+
+@app.on_event("shutdown")
+def shutdown_executors():
+    for executor in stage_executors.values():
+        executor.shutdown()
+
+
+@app.exception_handler(ExecutorBusyError)
+async def executor_busy_handler(request, exc: ExecutorBusyError):
+    return JSONResponse({'status_code': 1, 'description': '服务繁忙，请稍后重试', 'message': {'stage': exc.stage}},
+                        status_code=503)
+
+
 def build_response_json(status_code: int, description: str, message=None):
     """
     :param status_code: 只能为0或者1，0表示成功，1表示失败
@@ -39,8 +63,65 @@ def build_response_json(status_code: int, description: str, message=None):
                             status_code=400)
 
 
+def build_upload_dicom_info(temp_tags_dict):
+    return {
+        need_tags['0020|000e']: temp_tags_dict['0020|000e'],
+        need_tags['0010|0010']: temp_tags_dict['0010|0010'],
+        need_tags['0010|0040']: temp_tags_dict['0010|0040'],
+        need_tags['0010|0030']: temp_tags_dict['0010|0030'],
+        need_tags['0010|1010']: temp_tags_dict['0010|1010'],
+        need_tags['0020|0012']: temp_tags_dict['0020|0012'],
+        need_tags['0018|1030']: temp_tags_dict['0018|1030'],
+        need_tags['0008|0020']: temp_tags_dict['0008|0020'],
+        need_tags['0008|0030']: temp_tags_dict['0008|0030'],
+        need_tags['0008|0080']: temp_tags_dict['0008|0080']
+    }
+
+
+def read_upload_members(members):
+    """
+    直接在内存中解析上传的Dicom文件，只有在单个Series且为4帧时才解码像素
+    :return: (Series ID列表, 第一个文件的标签字典, 图像张量)，校验不通过时后两项为None
+    """
+    tags_list = [read_specific_tags(data, list(need_tags.keys()), stop_early=True) for _, data in members]
+    series_id = sorted({tags_dict['0020|000e'] for tags_dict in tags_list})
+    if len(series_id) != 1 or len(members) != 4:
+        return series_id, None, None
+    return series_id, tags_list[0], read_dicom_bytes([data for _, data in members])
+
+
+def read_upload_members_from_dir(members, tmpdir):
+    """
+    将上传的Dicom文件写出到临时目录，使用SimpleITK读取
+    :return: 同read_upload_members
+    """
+    for filename, data in members:
+        with open(os.path.join(tmpdir, filename), 'wb') as f:
+            f.write(data)
+    series_id = read_dicom.read_series_in_dir(tmpdir)
+    if len(series_id) != 1 or len(members) != 4:
+        return series_id, None, None
+    temp_tags_dict = read_specific_tags(os.path.join(tmpdir, members[0][0]), list(need_tags.keys()))
+    return series_id, temp_tags_dict, read_dicom_dir(tmpdir)
+
+
+def read_upload_series(members):
+    """
+    优先在内存中解析上传的Dicom文件，无法解码时退回临时目录方式
+    """
+    try:
+        return read_upload_members(members)
+    except read_dicom.UnsupportedDicomError:
+        # 像素数据被压缩等无法在内存中解码的情况，写出到临时目录后交给SimpleITK读取
+        with TemporaryDirectory() as tmpdir:
+            return read_upload_members_from_dir(members, tmpdir)
+
+
 @app.post("/upload_zip_file")
-async def upload_zip_file(tomography: str, topn: int, file: UploadFile = File(...)):
+async def upload_zip_file(tomography: str, topn: int, file: UploadFile = File(...), search_effort: int = None):
+    """
+    :param search_effort: 可选，本次检索的范围(IVF索引为nprobe，HNSW索引为efSearch)，越大召回率越高、速度越慢
+    """
     filename = file.filename
     if os.path.splitext(filename)[-1] != '.zip':
         return build_response_json(1, '上传的文件只能为zip格式')
@@ -48,52 +129,162 @@ async def upload_zip_file(tomography: str, topn: int, file: UploadFile = File(..
         return build_response_json(1, 'tomography参数只能为{}'.format(','.join(list(type_config.keys()))))
     if topn < 0 or topn > 20:
         return build_response_json(1, 'top参数不能为负数或大于20')
-    with TemporaryDirectory() as tmpdir:
-        with open(os.path.join(tmpdir, "temp.zip"), mode='wb') as tmpfile:
-            tmpfile.write(await file.read())
-        zip2dicom_dir(os.path.join(tmpdir, "temp.zip"), os.path.join(tmpdir, 'dicomfiles'))
-        series_id = read_dicom.read_series_in_dir(os.path.join(tmpdir, 'dicomfiles'))
+    if search_effort is not None and search_effort < 1:
+        return build_response_json(1, 'search_effort参数必须为正整数')
+    # 上传文件已由框架分块写入SpooledTemporaryFile，直接在内存中读取zip成员并解码，不经过临时目录
+    # 解压、解码、推理和检索都是阻塞操作，分别交给对应阶段的有界线程池执行
+    try:
+        members = await run_in_stage('decode', read_zip_dicom_members, file.file, 4,
+                                     serve_config['upload_max_member_bytes'])
+    except zipfile.BadZipFile:
+        return build_response_json(1, '上传的文件不是有效的zip文件')
+    except InvalidUploadError as e:
+        return build_response_json(1, str(e))
+    series_id, temp_tags_dict, image_array = await run_in_stage('decode', read_upload_series, members)
+    if len(series_id) != 1:
+        return build_response_json(1, '仅支持上传包含单个Dicom序列的zip文件')
+
+    message = {}
+    message['upload_dicom_info'] = build_upload_dicom_info(temp_tags_dict)
+    # 并发请求的推理由微批处理器合并为一次批量前向推理
+    feature_vector = await run_future_in_stage('inference', inference_batchers[tomography].submit, image_array)
+    results = await run_in_stage('db', search_similar_topn, feature_vector, topn, tomography, search_effort)
+    message['search_similarity_results'] = [result.to_dict() for result in results]
+    return build_response_json(0, 'success', message)
+
+
+def read_batch_upload(file):
+    """
+    读取批量检索上传的一个zip文件，出错时只记录该查询的错误，不影响其他查询
+    :return: (查询信息字典, 图像张量或None)
+    """
+    query = {'query': file.filename}
+    image_array = None
+    if os.path.splitext(file.filename)[-1] != '.zip':
+        query['error'] = '上传的文件只能为zip格式'
+        return query, None
+    try:
+        members = read_zip_dicom_members(file.file, 4, serve_config['upload_max_member_bytes'])
+        series_id, temp_tags_dict, image_array = read_upload_series(members)
         if len(series_id) != 1:
-            return build_response_json(1, '仅支持上传包含单个Dicom序列的zip文件')
-        files_list = os.listdir(os.path.join(tmpdir, 'dicomfiles'))
-        if len(files_list) != 4:
-            return build_response_json(1, '仅支持上传包含4帧的Dicom序列')
+            query['error'] = '仅支持上传包含单个Dicom序列的zip文件'
+        else:
+            query['upload_dicom_info'] = build_upload_dicom_info(temp_tags_dict)
+    except zipfile.BadZipFile:
+        query['error'] = '上传的文件不是有效的zip文件'
+    except InvalidUploadError as e:
+        query['error'] = str(e)
+    except Exception as e:
+        # Dicom文件损坏等内存解码和SimpleITK都无法读取的情况
+        logger.error(f'读取批量检索上传的文件{file.filename}时发生错误: {e}')
+        query['error'] = '无法读取上传的Dicom文件'
+    return query, image_array if 'error' not in query else None
 
-        message = {}
-        temp_tags_dict = read_specific_tags(os.path.join(tmpdir, 'dicomfiles', files_list[0]), list(need_tags.keys()))
-        message['upload_dicom_info'] = {
-            need_tags['0020|000e']: temp_tags_dict['0020|000e'],
-            need_tags['0010|0010']: temp_tags_dict['0010|0010'],
-            need_tags['0010|0040']: temp_tags_dict['0010|0040'],
-            need_tags['0010|0030']: temp_tags_dict['0010|0030'],
-            need_tags['0010|1010']: temp_tags_dict['0010|1010'],
-            need_tags['0020|0012']: temp_tags_dict['0020|0012'],
-            need_tags['0018|1030']: temp_tags_dict['0018|1030'],
-            need_tags['0008|0020']: temp_tags_dict['0008|0020'],
-            need_tags['0008|0030']: temp_tags_dict['0008|0030'],
-            need_tags['0008|0080']: temp_tags_dict['0008|0080']
-        }
-        model = load_model(tomography)
-        image_array = read_dicom_dir(os.path.join(tmpdir, 'dicomfiles'))
-        feature_vector = get_feature_vector(model, image_array)
-        results = search_similar_topn(feature_vector, topn, tomography)
-        message['search_similarity_results'] = [result.to_dict() for result in results]
-        return build_response_json(0, 'success', message)
+
+def read_batch_uploads(files):
+    """
+    依次读取批量检索上传的多个zip文件
+    :return: [(查询信息字典, 图像张量或None), ...]
+    """
+    return [read_batch_upload(file) for file in files]
+
+
+def infer_batch(tomography, image_arrays):
+    """
+    按矩阵大小分组，每组再按type_config中的batch_size分批推理多个查询，某一批推理失败时只影响该批的查询
+    :return: 与image_arrays顺序一致的列表，元素为(feature_vector_length,)的特征向量，推理失败时为None
+    """
+    model = model_registry.get(tomography)
+    batch_size = type_config[tomography]['batch_size']
+    vectors = [None] * len(image_arrays)
+    for indices in group_by_shape(image_arrays):
+        for start in range(0, len(indices), batch_size):
+            batch_indices = indices[start:start + batch_size]
+            try:
+                batch_vectors = get_feature_vectors(model, [image_arrays[i] for i in batch_indices])
+            except Exception as e:
+                logger.error(f'批量检索推理{len(batch_indices)}个查询时发生错误: {e}')
+                continue
+            for i, vector in zip(batch_indices, batch_vectors):
+                vectors[i] = vector
+    return vectors
+
+
+@app.post("/batch_search")
+async def batch_search(tomography: str, topn: int, files: List[UploadFile] = File(None), vectors: str = Form(None),
+                       search_effort: int = None):
+    """
+    批量检索：可以同时上传多个Series的zip文件(files)，和/或以JSON二维数组提交预先计算好的特征向量(vectors)，
+    所有查询向量通过一次Faiss检索完成，结果按查询顺序返回，zip文件在前，向量在后
+    search_effort的含义与/upload_zip_file相同
+    """
+    if tomography not in list(type_config.keys()):
+        return build_response_json(1, 'tomography参数只能为{}'.format(','.join(list(type_config.keys()))))
+    if topn < 1 or topn > 20:
+        return build_response_json(1, 'top参数不能小于1或大于20')
+    if search_effort is not None and search_effort < 1:
+        return build_response_json(1, 'search_effort参数必须为正整数')
+    files = files or []
+    feature_vector_length = type_config[tomography]['feature_vector_length']
+    try:
+        precomputed_vectors = np.asarray(json.loads(vectors) if vectors else [], dtype='float32')
+    except (ValueError, TypeError):
+        return build_response_json(1, 'vectors参数必须为JSON格式的二维数组')
+    if precomputed_vectors.size == 0:
+        precomputed_vectors = precomputed_vectors.reshape(0, feature_vector_length)
+    if precomputed_vectors.ndim != 2 or precomputed_vectors.shape[1] != feature_vector_length:
+        return build_response_json(1, f'vectors中每个向量的长度必须为{feature_vector_length}')
+    query_count = len(files) + len(precomputed_vectors)
+    if query_count == 0:
+        return build_response_json(1, '至少需要提供一个zip文件或特征向量')
+    if query_count > serve_config['batch_search_max_queries']:
+        return build_response_json(1, f"单次请求的查询数量不能超过{serve_config['batch_search_max_queries']}")
+
+    # 按batch_size分块读取并推理，每块推理后只保留特征向量，峰值内存只与batch_size有关，不随上传文件数量增长
+    batch_size = type_config[tomography]['batch_size']
+    queries = []
+    feature_vectors = []
+    for start in range(0, len(files), batch_size):
+        uploads = await run_in_stage('decode', read_batch_uploads, files[start:start + batch_size])
+        queries.extend(query for query, _ in uploads)
+        uploads = [(query, image_array) for query, image_array in uploads if image_array is not None]
+        if uploads:
+            vectors = await run_in_stage('inference', infer_batch, tomography,
+                                         [image_array for _, image_array in uploads])
+            for (query, _), vector in zip(uploads, vectors):
+                if vector is None:
+                    query['error'] = '无法提取上传的Dicom序列的特征向量'
+                else:
+                    feature_vectors.append(vector[np.newaxis, :])
+    feature_vectors.append(precomputed_vectors)
+    for i in range(len(precomputed_vectors)):
+        queries.append({'query': f'vector_{i}'})
+    searchable_queries = [query for query in queries if 'error' not in query]
+    if searchable_queries:
+        results = await run_in_stage('db', search_similar_topn_batch, np.concatenate(feature_vectors), topn,
+                                     tomography, search_effort)
+        if results is None:
+            return build_response_json(1, '检索失败，索引文件不存在')
+        for query, query_results in zip(searchable_queries, results):
+            query['search_similarity_results'] = [result.to_dict() for result in query_results]
+    return build_response_json(0, 'success', {'results': queries})
 
 
 @app.get("/download_dicom_zip")
 async def download_dicom_zip(series_id: str):
-    paths = query_saving_path_by_series_id(series_id)
+    paths = await run_in_stage('db', query_saving_path_by_series_id, series_id)
     if not paths:
         return build_response_json(1, f'数据库中没有Series ID为{series_id}的记录')
-    dicom_files2zip(paths, f"{series_id}.zip")
-
-    def rm_file(file_path):
-        if os.path.exists(file_path):
-            os.remove(file_path)
-
-    task = BackgroundTask(rm_file, file_path=f"{series_id}.zip")
-    return FileResponse(f"{series_id}.zip", filename=f"{series_id}.zip", background=task)
+    if zip_cache is not None:
+        cached_file = zip_cache.get(series_id)
+        if cached_file:
+            return FileResponse(cached_file, filename=f"{series_id}.zip")
+    # 边读取Dicom文件边向客户端发送zip内容，不在磁盘上生成临时压缩包
+    chunks = iter_dicom_zip(paths)
+    if zip_cache is not None:
+        chunks = zip_cache.tee(series_id, chunks)
+    return StreamingResponse(chunks, media_type='application/zip',
+                             headers={'Content-Disposition': f'attachment; filename="{series_id}.zip"'})
 
 
 if __name__ == '__main__':
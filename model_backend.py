@@ -1,11 +1,17 @@
 import numpy as np
 import os
-import SimpleITK as sitk
+import queue
+import threading
+import time
+from concurrent.futures import Future
 from torchvision.transforms import transforms
 import torch
 import torch.nn as nn
 import torchvision.models as models
 from config import *
+from read_dicom import dicom_bytes2array, slice_position
+
+# SimpleITK只在读取Dicom文件的函数中导入，在线服务在内存中解码上传文件时不加载它
 
 use_cuda = torch.cuda.is_available() and True
 
@@ -65,20 +71,54 @@ class Resnet34Triplet(nn.Module):
 
 
 def read_dicom_dir(path, transform: bool = True):
-    filenames = os.listdir(path)
-    for filename in filenames:
-        if os.path.splitext(filename)[-1] != '.dcm':
-            filenames.remove(filename)
+    import SimpleITK as sitk
     reader = sitk.ImageSeriesReader()
     img_names = reader.GetGDCMSeriesFileNames(path)
-    reader.SetFileNames(img_names)
-    image = reader.Execute()
-    image_array = sitk.GetArrayFromImage(image)  # z, y, x
+    return read_dicom_files(img_names, transform)
+
+
+def read_dicom_files(file_paths: list, transform: bool = True):
+    """
+    直接读取一个Series的所有Dicom文件，无需先将文件复制到同一目录
+    :param file_paths: 同一个Series的Dicom文件路径列表，已按切片位置排序
+    """
+    image_array = preprocess_array(decode_dicom_files(file_paths), transform)
+    if use_cuda:
+        image_array = image_array.cuda()
+    return image_array
+
+
+def decode_dicom_files(file_paths: list):
+    """
+    只进行Dicom文件的读取和解码，返回z, y, x排列的numpy数组，每个文件只读取一次
+    :param file_paths: 已按切片位置排序的文件路径(GetGDCMSeriesFileNames的结果或数据库中按SlicePosition排序的路径)
+    """
+    import SimpleITK as sitk
+    reader = sitk.ImageSeriesReader()
+    reader.SetFileNames([str(file_path) for file_path in file_paths])
+    return sitk.GetArrayFromImage(reader.Execute())
+
+
+def read_dicom_bytes(dicom_bytes_list: list, transform: bool = True):
+    """
+    直接从内存中的Dicom文件内容(如zip成员)构建z, y, x图像并预处理，不经过临时文件，结果与read_dicom_dir一致
+    像素数据被压缩等无法直接解码的情况会抛出read_dicom.UnsupportedDicomError
+    """
+    slices = [dicom_bytes2array(dicom_bytes) for dicom_bytes in dicom_bytes_list]
+    slices.sort(key=lambda item: slice_position(item[0]))
+    image_array = preprocess_array(np.stack([pixels for _, pixels in slices]), transform)
+    if use_cuda:
+        image_array = image_array.cuda()
+    return image_array
+
+
+def preprocess_array(image_array, transform: bool = True):
+    """
+    将z, y, x排列的图像数组转换为(1, z, y, x)的float张量，结果保留在CPU上
+    """
     image_array = image_array.transpose(1, 2, 0).astype('float')
     if transform:
         image_array = data_transforms(image_array)
-    if use_cuda:
-        image_array = image_array.cuda()
     image_array = image_array.type(torch.float)
     return torch.unsqueeze(image_array, 0)
 
@@ -99,6 +139,178 @@ def load_model(tomography_type):
 
 
 def get_feature_vector(model, image_array):
-    result = model(image_array)
+    with torch.no_grad():
+        result = model(image_array)
     vector_numpy = result.cpu().detach().numpy()
     return vector_numpy
+
+
+def group_by_shape(image_arrays: list):
+    """
+    按(C, H, W)对图像张量分组，矩阵大小不同的张量不能拼接到同一个批次中
+    :return: 每组为image_arrays中形状相同的张量下标列表，各组按首次出现的顺序排列
+    """
+    groups = {}
+    for i, image_array in enumerate(image_arrays):
+        groups.setdefault(tuple(image_array.shape[1:]), []).append(i)
+    return list(groups.values())
+
+
+def get_feature_vectors(model, image_arrays: list):
+    """
+    将多个(1, 4, H, W)的图像张量按矩阵大小分组拼接，每组只进行一次前向推理
+    ResNet使用自适应池化，不同矩阵大小的输入得到相同长度的特征向量
+    :return: (N, feature_vector_length)的特征向量数组，顺序与image_arrays一致
+    """
+    groups = group_by_shape(image_arrays)
+    vectors = [None] * len(image_arrays)
+    for indices in groups:
+        batch = torch.cat([image_arrays[i] for i in indices], 0)
+        if use_cuda:
+            batch = batch.cuda()
+        with torch.no_grad():
+            result = model(batch).cpu().numpy()
+        if len(groups) == 1:
+            return result
+        for i, vector in zip(indices, result):
+            vectors[i] = vector
+    return np.stack(vectors)
+
+
+class ModelRegistry:
+    """
+    进程内模型缓存，按断层扫描类型保存已加载的模型，每个模型只加载一次并常驻于eval模式，
+    推理均在torch.no_grad()下进行，不修改模型状态，因此可以在并发请求之间共享
+    """
+
+    def __init__(self):
+        self._models = {}
+        self._model_mtimes = {}
+        self._lock = threading.Lock()
+
+    def get(self, tomography_type):
+        """
+        获取指定类型的模型，若尚未加载则在首次使用时加载
+        """
+        model = self._models.get(tomography_type)
+        if model is not None:
+            return model
+        with self._lock:
+            # 双重检查，避免并发请求重复加载同一个模型
+            model = self._models.get(tomography_type)
+            if model is None:
+                model = self._load(tomography_type)
+            return model
+
+    def reload(self, tomography_type):
+        """
+        重新从.pth文件加载模型并替换缓存，正在使用旧模型的请求不受影响
+        """
+        with self._lock:
+            return self._load(tomography_type)
+
+    def reload_if_changed(self, tomography_type):
+        """
+        若.pth文件的修改时间发生变化则重新加载模型，返回是否进行了重新加载
+        """
+        model_file = type_config[tomography_type]['model_file']
+        if os.path.getmtime(model_file) == self._model_mtimes.get(tomography_type):
+            return False
+        self.reload(tomography_type)
+        return True
+
+    def preload(self, tomography_types=None, share_memory: bool = False):
+        """
+        在应用启动时预先加载模型，默认加载type_config中的所有类型
+        :param share_memory: 将模型权重移动到共享内存，之后fork出的worker进程直接使用同一份权重(仅CPU推理时有效)
+        """
+        for tomography_type in tomography_types or list(type_config.keys()):
+            model = self.get(tomography_type)
+            if share_memory and not use_cuda:
+                model.share_memory()
+
+    def _load(self, tomography_type):
+        model = load_model(tomography_type)
+        mtime = os.path.getmtime(type_config[tomography_type]['model_file'])
+        self._models[tomography_type] = model
+        self._model_mtimes[tomography_type] = mtime
+        return model
+
+
+model_registry = ModelRegistry()
+
+
+class InferenceBatcher:
+    """
+    在线推理的动态微批处理：在max_wait_ms内到达的请求最多合并max_batch个，进行一次批量前向推理，
+    再把各自的特征向量分别返回给对应请求。只有最近出现过并发请求时才等待，低负载时请求立即推理，不增加延迟
+    """
+
+    def __init__(self, tomography_type, max_batch: int = None, max_wait_ms: float = None):
+        self.tomography_type = tomography_type
+        self.max_batch = max_batch or type_config[tomography_type]['max_batch']
+        self.max_wait = (max_wait_ms if max_wait_ms is not None else type_config[tomography_type]['max_wait_ms']) / 1000
+        self._queue = queue.Queue()
+        self._last_batch_size = 1
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, image_array):
+        """
+        :param image_array: (1, 4, H, W)的图像张量
+        :return: concurrent.futures.Future，结果为(1, feature_vector_length)的特征向量
+        """
+        future = Future()
+        self._queue.put((image_array, future))
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._worker, daemon=True,
+                                                    name=f'{self.tomography_type}-batcher')
+                    self._thread.start()
+        return future
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        # 先取出已经在排队的请求
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        # 最近有并发请求时，再等待一小段时间凑批
+        if self._last_batch_size > 1 or len(batch) > 1:
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+        self._last_batch_size = len(batch)
+        return batch
+
+    def _worker(self):
+        while True:
+            batch = self._collect()
+            futures = [future for _, future in batch if future.set_running_or_notify_cancel()]
+            image_arrays = [image_array for image_array, future in batch if future in futures]
+            if not futures:
+                continue
+            # 不同矩阵大小的请求分组推理，某一组推理失败时只影响该组的请求
+            for indices in group_by_shape(image_arrays):
+                group_futures = [futures[i] for i in indices]
+                try:
+                    vectors = get_feature_vectors(model_registry.get(self.tomography_type),
+                                                  [image_arrays[i] for i in indices])
+                except Exception as e:
+                    for future in group_futures:
+                        future.set_exception(e)
+                    continue
+                for future, vector in zip(group_futures, vectors):
+                    future.set_result(vector[np.newaxis, :])
+
+
+inference_batchers = {tomography_type: InferenceBatcher(tomography_type) for tomography_type in type_config.keys()}
@@ -0,0 +1,133 @@
+"""
+建库时的流式特征提取流水线：
+1. 读取阶段：线程池并行使用SimpleITK读取并解码每个Series的Dicom文件
+2. 预处理阶段：对解码后的图像数组执行data_transforms，转换为张量
+3. 推理阶段：按矩阵大小分别凑批拼接张量，每批进行一次前向推理，产出(IndexID数组, 特征向量数组)
+各阶段之间使用有界队列连接，磁盘、CPU和GPU可以同时工作，且内存占用不随数据量增长
+"""
+import queue
+import threading
+import time
+import numpy as np
+from loguru import logger
+from tqdm import tqdm
+from model_backend import decode_dicom_files, preprocess_array, get_feature_vectors
+from config import *
+
+# 队列结束标记
+_STOP = object()
+
+
+class FeaturePipeline:
+    def __init__(self, model, batch_size: int, decode_workers: int = None, queue_size: int = None):
+        self.model = model
+        self.batch_size = batch_size
+        self.decode_workers = decode_workers or pipeline_config['decode_workers']
+        queue_size = queue_size or pipeline_config['queue_size']
+        self._task_queue = queue.Queue(maxsize=queue_size)
+        self._decoded_queue = queue.Queue(maxsize=queue_size)
+        self._tensor_queue = queue.Queue(maxsize=max(queue_size, batch_size))
+        self._errors = []
+        self._failed = 0
+        self._failed_lock = threading.Lock()
+
+    def run(self, series_files, total: int = None):
+        """
+        :param series_files: (IndexID, 该Series的文件路径列表)的可迭代对象
+        :param total: Series总数，仅用于进度条显示
+        :return: 生成器，每次产出(ids_array, features_array)，分别为int64和float32数组
+        """
+        threads = [threading.Thread(target=self._feed, args=(series_files,), daemon=True)]
+        threads += [threading.Thread(target=self._decode, daemon=True) for _ in range(self.decode_workers)]
+        threads.append(threading.Thread(target=self._preprocess, daemon=True))
+        for thread in threads:
+            thread.start()
+
+        progress = tqdm(total=total, unit='series')
+        start_time = time.time()
+        finished = 0
+        # 矩阵大小不同的张量不能拼接，按(C, H, W)分别凑批：shape -> (IndexID列表, 张量列表)
+        batches = {}
+        stopped = False
+        while not stopped:
+            item = self._tensor_queue.get()
+            if item is _STOP:
+                stopped = True
+            else:
+                batch_ids, batch_arrays = batches.setdefault(tuple(item[1].shape[1:]), ([], []))
+                batch_ids.append(item[0])
+                batch_arrays.append(item[1])
+            # 某个形状凑满一个批次时推理该批次，上游暂时没有数据时推理所有批次，避免GPU空等
+            flush_all = stopped or self._tensor_queue.empty()
+            for shape in [shape for shape, (batch_ids, _) in batches.items()
+                          if flush_all or len(batch_ids) >= self.batch_size]:
+                batch_ids, batch_arrays = batches.pop(shape)
+                progress.update(len(batch_ids))
+                progress.set_postfix(self._queue_depths())
+                try:
+                    features_array = get_feature_vectors(self.model, batch_arrays).astype('float32')
+                except Exception as e:
+                    logger.error(f'推理IndexID为{batch_ids[0]}等{len(batch_ids)}个Series时出错：{e}')
+                    for _ in batch_ids:
+                        self._mark_failed()
+                    continue
+                finished += len(batch_ids)
+                yield np.array(batch_ids).astype('int64'), features_array
+        progress.close()
+        for thread in threads:
+            thread.join()
+        if self._errors:
+            raise self._errors[0]
+        elapsed = max(time.time() - start_time, 1e-6)
+        logger.info(f'流水线处理完成：共{finished}个Series，失败{self._failed}个，'
+                    f'平均{finished / elapsed:.1f}个Series/秒')
+
+    def _queue_depths(self):
+        return {
+            'decode_q': self._task_queue.qsize(),
+            'preprocess_q': self._decoded_queue.qsize(),
+            'infer_q': self._tensor_queue.qsize()
+        }
+
+    def _mark_failed(self):
+        with self._failed_lock:
+            self._failed += 1
+
+    def _feed(self, series_files):
+        try:
+            for task in series_files:
+                self._task_queue.put(task)
+        except Exception as e:
+            logger.error(f'读取待处理Series列表时出错：{e}')
+            self._errors.append(e)
+        finally:
+            for _ in range(self.decode_workers):
+                self._task_queue.put(_STOP)
+
+    def _decode(self):
+        while True:
+            task = self._task_queue.get()
+            if task is _STOP:
+                self._decoded_queue.put(_STOP)
+                return
+            index_id, file_paths = task
+            try:
+                self._decoded_queue.put((index_id, decode_dicom_files(file_paths)))
+            except Exception as e:
+                logger.error(f'读取IndexID为{index_id}的Series时出错：{e}')
+                self._mark_failed()
+
+    def _preprocess(self):
+        remaining = self.decode_workers
+        while remaining:
+            item = self._decoded_queue.get()
+            if item is _STOP:
+                remaining -= 1
+                continue
+            index_id, image_array = item
+            try:
+                self._tensor_queue.put((index_id, preprocess_array(image_array)))
+            except Exception as e:
+                logger.error(f'预处理IndexID为{index_id}的Series时出错：{e}')
+                self._mark_failed()
+        self._tensor_queue.put(_STOP)
@@ -1,10 +1,36 @@
-import SimpleITK as sitk
-from description import DicomDictionary
+import base64
+import io
+import struct
+from functools import lru_cache
+import numpy as np
+from dicom_dictionary import lookup_tag, lookup_keyword
 
+# SimpleITK只在通过它读取文件的函数中导入，只使用纯Python解析的代码路径不会加载它
 
+# 显式VR中使用2字节保留位+4字节长度的VR
+_LONG_LENGTH_VRS = {'OB', 'OD', 'OF', 'OL', 'OV', 'OW', 'SQ', 'UC', 'UN', 'UR', 'UT', 'SV', 'UV'}
+# 以二进制存储数值的VR及其struct格式
+_BINARY_VRS = {'US': 'H', 'SS': 'h', 'UL': 'I', 'SL': 'i', 'FL': 'f', 'FD': 'd', 'UV': 'Q', 'SV': 'q'}
+_IMPLICIT_VR_LITTLE_ENDIAN = '1.2.840.10008.1.2'
+# 大端序和Deflate压缩的数据集无法直接扫描，交给SimpleITK处理
+_UNSUPPORTED_TRANSFER_SYNTAXES = {'1.2.840.10008.1.2.2', '1.2.840.10008.1.2.1.99'}
+_PIXEL_DATA_TAG = 0x7FE00010
+_ITEM_TAG = 0xFFFEE000
+_ITEM_DELIMITATION_TAG = 0xFFFEE00D
+_SEQUENCE_DELIMITATION_TAG = 0xFFFEE0DD
+_UNDEFINED_LENGTH = 0xFFFFFFFF
+_FLOAT_VRS = {'FL', 'FD'}
+# 与SimpleITK(GDCM)一致，以base64编码输出的二进制VR
+_BASE64_VRS = {'OB', 'OD', 'OF', 'OL', 'OV', 'OW', 'UN'}
+
+
+class UnsupportedDicomError(ValueError):
+    pass
+
+
+@lru_cache(maxsize=65536)
 def get_description(group: str, element: str, space: bool = False):
-    code = ''.join(['0x', group, element])
-    desc = DicomDictionary.get(eval(code))
+    desc = lookup_tag(int(group + element, 16))
     if desc:
         if space:
             return desc[2]
@@ -14,29 +40,341 @@ def get_description(group: str, element: str, space: bool = False):
         return ''
 
 
+@lru_cache(maxsize=65536)
+def int2tag(tag: int):
+    """
+    将整数标签0x0020000E转换为'0020|000e'格式
+    """
+    return f'{tag >> 16:04x}|{tag & 0xFFFF:04x}'
+
+
+def keyword2tag(keyword: str):
+    """
+    将关键字转换为'0010|0010'格式的标签，如'PatientName' -> '0010|0010'，未知关键字返回None
+    """
+    tag = lookup_keyword(keyword)
+    return int2tag(tag) if tag is not None else None
+
+
+def tag2int(tag: str):
+    """
+    将'0020|000e'格式的标签转换为整数0x0020000E
+    """
+    return int(tag.replace('|', ''), 16)
+
+
+def _dictionary_vr(tag: int):
+    """
+    数据字典中的VR，有多种可能时(如'US or SS')取第一种，字典中没有该标签时为UN
+    """
+    desc = lookup_tag(tag)
+    return desc[0].split(' or ')[0] if desc and desc[0] else 'UN'
+
+
+def _read_exact(fp, length):
+    data = fp.read(length)
+    if len(data) != length:
+        raise UnsupportedDicomError('Unexpected end of file')
+    return data
+
+
+def _read_element_header(fp, explicit: bool):
+    """
+    :return: (tag, vr, length)，文件结束时返回None
+    """
+    head = fp.read(8)
+    if len(head) < 8:
+        return None
+    group, element = struct.unpack('<HH', head[:4])
+    tag = (group << 16) | element
+    # Item相关的标签总是使用隐式的4字节长度
+    if not explicit or group == 0xFFFE:
+        return tag, None, struct.unpack('<I', head[4:])[0]
+    # VR必须是两个大写字母，否则说明数据实际按其他编码写入或解析位置已经错位
+    if not (65 <= head[4] <= 90 and 65 <= head[5] <= 90):
+        raise UnsupportedDicomError(f'Invalid VR {head[4:6]!r} in tag {int2tag(tag)}')
+    vr = head[4:6].decode('ascii')
+    if vr in _LONG_LENGTH_VRS:
+        return tag, vr, struct.unpack('<I', _read_exact(fp, 4))[0]
+    return tag, vr, struct.unpack('<H', head[6:])[0]
+
+
+def _skip_undefined_length(fp, explicit: bool):
+    """
+    跳过长度未定义的序列，直到遇到序列结束标记
+    """
+    while True:
+        header = _read_element_header(fp, explicit)
+        if header is None:
+            raise UnsupportedDicomError('Unexpected end of file in sequence')
+        tag, _, length = header
+        if tag == _SEQUENCE_DELIMITATION_TAG:
+            return
+        if tag == _ITEM_TAG and length == _UNDEFINED_LENGTH:
+            _skip_item(fp, explicit)
+        elif length != _UNDEFINED_LENGTH:
+            fp.seek(length, 1)
+
+
+def _skip_item(fp, explicit: bool):
+    while True:
+        header = _read_element_header(fp, explicit)
+        if header is None:
+            raise UnsupportedDicomError('Unexpected end of file in item')
+        tag, vr, length = header
+        if tag == _ITEM_DELIMITATION_TAG:
+            return
+        if length == _UNDEFINED_LENGTH:
+            # 显式VR下UN类型的未定义长度序列，其内容按隐式VR编码
+            _skip_undefined_length(fp, explicit and vr != 'UN')
+        else:
+            fp.seek(length, 1)
+
+
+def read_header_elements(source, tags=None, stop_early: bool = True, pixel_data: bool = False):
+    """
+    只扫描Dicom文件头，不读取像素数据，遇到像素数据或已越过所有需要的标签时立即停止
+    :param source: 文件路径、bytes或可随机访问的二进制文件对象
+    :param tags: 需要读取的整数标签集合，为None时读取像素数据之前的所有顶层标签，
+                 同时stop_early为False时跳过像素数据，继续读取其后的顶层标签(如数据集末尾的填充)
+    :param stop_early: 是否在读取到tags中最大的标签后停止解析
+    :param pixel_data: 为True时一并读取未压缩的像素数据，压缩(封装)的像素数据会抛出UnsupportedDicomError
+    :return: ({tag: (vr, value_bytes)}, transfer_syntax_uid)，隐式VR时vr从字典中查询
+    """
+    if isinstance(source, (bytes, bytearray)):
+        fp = io.BytesIO(source)
+    elif isinstance(source, str):
+        with open(source, 'rb') as f:
+            return read_header_elements(f, tags, stop_early, pixel_data)
+    else:
+        fp = source
+    preamble = fp.read(132)
+    if preamble[128:132] != b'DICM':
+        raise UnsupportedDicomError('Missing DICM prefix')
+    wanted = set(tags) if tags is not None else None
+    read_trailing = wanted is None and not stop_early and not pixel_data
+    stop_tag = max(wanted) if wanted and stop_early and not pixel_data else _PIXEL_DATA_TAG
+    if read_trailing:
+        stop_tag = _UNDEFINED_LENGTH
+    elements = {}
+    transfer_syntax = None
+    explicit = True
+    while True:
+        position = fp.tell()
+        header = _read_element_header(fp, explicit)
+        if header is None:
+            break
+        tag, vr, length = header
+        if tag >> 16 != 0x0002 and transfer_syntax is None:
+            raise UnsupportedDicomError('Missing transfer syntax')
+        if tag >> 16 != 0x0002 and explicit and transfer_syntax == _IMPLICIT_VR_LITTLE_ENDIAN:
+            # 文件元信息结束，数据集改为隐式VR，按隐式VR重新读取当前元素
+            explicit = False
+            fp.seek(position)
+            continue
+        if tag == _PIXEL_DATA_TAG and pixel_data:
+            if length == _UNDEFINED_LENGTH:
+                raise UnsupportedDicomError(f'Encapsulated pixel data in transfer syntax {transfer_syntax}')
+            elements[tag] = (vr or 'OW', _read_exact(fp, length))
+            break
+        if tag == _PIXEL_DATA_TAG and read_trailing:
+            if length == _UNDEFINED_LENGTH:
+                _skip_undefined_length(fp, False)
+            else:
+                fp.seek(length, 1)
+            continue
+        if (tag >= _PIXEL_DATA_TAG and not read_trailing) or tag > stop_tag:
+            break
+        if vr is None:
+            vr = _dictionary_vr(tag)
+        if length == _UNDEFINED_LENGTH:
+            _skip_undefined_length(fp, explicit and vr != 'UN')
+            continue
+        if wanted is None or tag in wanted or tag == 0x00020010:
+            value = _read_exact(fp, length)
+            elements[tag] = (vr, value)
+            if tag == 0x00020010:
+                transfer_syntax = value.rstrip(b'\x00 ').decode('ascii')
+                if transfer_syntax in _UNSUPPORTED_TRANSFER_SYNTAXES:
+                    raise UnsupportedDicomError(f'Unsupported transfer syntax {transfer_syntax}')
+        else:
+            fp.seek(length, 1)
+    return elements, transfer_syntax
+
+
+def element2str(vr: str, value: bytes, charcode: str = 'gbk'):
+    """
+    将元素值转换为与SimpleITK的GetMetaData一致的字符串，二进制数值以\\分隔
+    """
+    if vr == 'AT':
+        # 标签值为(组号, 元素号)两个uint16，与GDCM一样输出为(gggg,eeee)
+        count = len(value) // 4
+        values = struct.unpack(f'<{count * 2}H', value[:count * 4])
+        return '\\'.join(f'({values[i]:04x},{values[i + 1]:04x})' for i in range(0, len(values), 2))
+    fmt = _BINARY_VRS.get(vr)
+    if fmt:
+        count = len(value) // struct.calcsize(fmt)
+        values = struct.unpack(f'<{count}{fmt}', value[:count * struct.calcsize(fmt)])
+        if vr in _FLOAT_VRS:
+            # 与GDCM使用的C++流默认格式一致：6位有效数字，去掉多余的0，如3816.22、20、8.624e+08
+            return '\\'.join(f'{v:g}' for v in values)
+        return '\\'.join(str(v) for v in values)
+    return value.rstrip(b'\x00').decode(charcode, 'replace')
+
+
+def _element2numbers(elements, tag, default=None):
+    """
+    数值格式错误时抛出UnsupportedDicomError，由调用方退回SimpleITK处理
+    """
+    element = elements.get(tag)
+    if element is None:
+        return default
+    value = element2str(*element).strip()
+    if not value:
+        return default
+    try:
+        return [float(v) for v in value.split('\\')]
+    except ValueError:
+        raise UnsupportedDicomError(f'Invalid numeric value {value!r} in tag {int2tag(tag)}')
+
+
+def dicom_bytes2array(data: bytes):
+    """
+    直接从内存中的Dicom文件内容解码出单帧图像，并与SimpleITK一致地应用RescaleSlope和RescaleIntercept
+    仅支持未压缩的像素数据，其他情况抛出UnsupportedDicomError
+    :return: (elements, (y, x)的float64数组)
+    """
+    elements, _ = read_header_elements(data, None, pixel_data=True)
+    if _PIXEL_DATA_TAG not in elements:
+        raise UnsupportedDicomError('Missing pixel data')
+    rows = int(_element2numbers(elements, 0x00280010, [0])[0])
+    columns = int(_element2numbers(elements, 0x00280011, [0])[0])
+    samples = int(_element2numbers(elements, 0x00280002, [1])[0])
+    frames = int(_element2numbers(elements, 0x00280008, [1])[0])
+    bits_allocated = int(_element2numbers(elements, 0x00280100, [0])[0])
+    signed = int(_element2numbers(elements, 0x00280103, [0])[0]) == 1
+    if not rows or not columns or samples != 1 or frames != 1 or bits_allocated not in (8, 16, 32):
+        raise UnsupportedDicomError('Only single frame grayscale images are supported')
+    dtype = np.dtype(f"<{'i' if signed else 'u'}{bits_allocated // 8}")
+    pixels = elements[_PIXEL_DATA_TAG][1]
+    if len(pixels) < rows * columns * dtype.itemsize:
+        raise UnsupportedDicomError('Pixel data is shorter than Rows * Columns')
+    image_array = np.frombuffer(pixels, dtype=dtype, count=rows * columns).reshape(rows, columns).astype('float')
+    slope = _element2numbers(elements, 0x00281053, [1.0])[0]
+    intercept = _element2numbers(elements, 0x00281052, [0.0])[0]
+    return elements, image_array * slope + intercept
+
+
+# 计算切片位置需要的标签：InstanceNumber、ImagePositionPatient、ImageOrientationPatient
+SLICE_POSITION_TAGS = ['0020|0013', '0020|0032', '0020|0037']
+
+
+def _slice_position(position, orientation, instance_number):
+    if position and orientation and len(position) == 3 and len(orientation) == 6:
+        return float(np.dot(np.cross(orientation[:3], orientation[3:]), position))
+    return instance_number
+
+
+def slice_position(elements):
+    """
+    与GetGDCMSeriesFileNames一致，计算ImagePositionPatient在切片法向量上的投影，缺少位置信息时返回InstanceNumber
+    """
+    return _slice_position(_element2numbers(elements, 0x00200032), _element2numbers(elements, 0x00200037),
+                           _element2numbers(elements, 0x00200013, [0.0])[0])
+
+
+def tags2slice_position(tags_dict):
+    """
+    与slice_position相同，从read_specific_tags读取的SLICE_POSITION_TAGS计算切片位置，数值格式错误时返回None
+    """
+    def numbers(tag):
+        value = tags_dict.get(tag, '').strip()
+        return [float(v) for v in value.split('\\')] if value else None
+
+    try:
+        return _slice_position(numbers('0020|0032'), numbers('0020|0037'), (numbers('0020|0013') or [0.0])[0])
+    except ValueError:
+        return None
+
+
+def sort_by_slice_position(file_paths: list):
+    """
+    只扫描文件头中的位置标签，按切片位置升序排列文件，用于没有记录SlicePosition的旧数据
+    """
+    positions = [tags2slice_position(read_specific_tags(file_path, SLICE_POSITION_TAGS, stop_early=True))
+                 for file_path in file_paths]
+    if any(position is None for position in positions):
+        return list(file_paths)
+    return [file_path for _, file_path in sorted(zip(positions, file_paths), key=lambda pair: pair[0])]
+
+
 def read_tags(path, description: bool = True):
+    """
+    读取文件头中除文件元信息和序列以外的所有标签，与SimpleITK的GetMetaDataKeys一致
+    优先使用纯Python扫描文件头，遇到不支持的编码时退回SimpleITK
+    :return: [(tag, 关键字, 值), ...]，description为False时为[(tag, 值), ...]
+    """
+    try:
+        elements, _ = read_header_elements(path, stop_early=False)
+    except UnsupportedDicomError:
+        return _read_tags_sitk(path, description)
+    charset = elements.get(0x00080005)
+    charcode = element2str(*charset, 'utf-8').strip() if charset else 'utf-8'
+    tags = []
+    for tag, (vr, value) in elements.items():
+        if vr == 'UN':
+            # 与GDCM一致，显式VR为UN的元素按数据字典中的VR解释，字典中为SQ的元素同样作为序列跳过
+            vr = _dictionary_vr(tag)
+        if tag >> 16 == 0x0002 or vr == 'SQ':
+            continue
+        tag_str = int2tag(tag)
+        try:
+            if vr in _BASE64_VRS:
+                value = base64.b64encode(value).decode('ascii')
+            else:
+                value = element2str(vr, value, charcode).strip()
+        except Exception as e:
+            value = e
+        if description:
+            desc = lookup_tag(tag)
+            tags.append((tag_str, desc[4] if desc else '', value))
+        else:
+            tags.append((tag_str, value))
+    return tags
+
+
+def read_series_tags(paths, description: bool = True):
+    """
+    批量读取一个Series中所有文件的标签，标签和描述的转换结果在文件之间共享缓存
+    :return: 与paths顺序一致的read_tags结果列表
+    """
+    return [read_tags(path, description) for path in paths]
+
+
+def _read_tags_sitk(path, description: bool = True):
+    import SimpleITK as sitk
     reader = sitk.ImageFileReader()
     reader.SetFileName(path)
     reader.LoadPrivateTagsOn()
+    # 只读取文件头信息，不解码像素数据
     reader.ReadImageInformation()
-    image = reader.Execute()
     try:
-        charcode = image.GetMetaData("0008|0005").strip().encode("utf-8", "surrogateescape").decode()
+        charcode = reader.GetMetaData("0008|0005").strip().encode("utf-8", "surrogateescape").decode()
     except:
         charcode = 'utf-8'
     tags = []
-    for i in image.GetMetaDataKeys():
+    for i in reader.GetMetaDataKeys():
         if "|" in i:
             try:
                 if description:
                     tags.append(
                         (i, get_description(*(i.split("|"))),
-                         image.GetMetaData(i).strip().encode("utf-8", "surrogateescape").decode(charcode, 'replace')))
+                         reader.GetMetaData(i).strip().encode("utf-8", "surrogateescape").decode(charcode, 'replace')))
                 else:
                     tags.append(
                         (
-                            i, image.GetMetaData(i).strip().encode("utf-8", "surrogateescape").decode(charcode,
-                                                                                                      'replace')))
+                            i, reader.GetMetaData(i).strip().encode("utf-8", "surrogateescape").decode(charcode,
+                                                                                                       'replace')))
             except Exception as e:
                 if description:
                     tags.append((i, get_description(*i.split("|")), e))
@@ -46,17 +384,44 @@ def read_tags(path, description: bool = True):
     return tags
 
 
-def read_specific_tag(dcm_file, tag, default=''):
-    dcm = sitk.ReadImage(dcm_file)
-    try:
-        return dcm.GetMetaData(tag).strip().encode("utf-8", "surrogateescape").decode('gbk', 'replace')
-    except Exception as e:
-        print(e)
-        return default
+def read_header(dcm_file):
+    """
+    只读取文件头信息，返回已执行ReadImageInformation的ImageFileReader，可以像Image一样调用GetMetaData
+    """
+    import SimpleITK as sitk
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(dcm_file)
+    reader.ReadImageInformation()
+    return reader
 
 
-def read_specific_tags(dcm_file, tags: list, default=""):
-    dcm = sitk.ReadImage(dcm_file)
+def read_specific_tag(dcm_file, tag, default='', stop_early: bool = False):
+    return read_specific_tags(dcm_file, [tag], default, stop_early)[tag]
+
+
+def read_specific_tags(dcm_file, tags: list, default="", stop_early: bool = False):
+    """
+    :param dcm_file: Dicom文件路径，stop_early为True时也可以是文件内容bytes
+    :param stop_early: 为True时使用纯Python扫描文件头，读到tags中最大的标签后立即停止解析，
+                       遇到不支持的编码时退回SimpleITK的只读文件头方式
+    """
+    if stop_early:
+        try:
+            elements, _ = read_header_elements(dcm_file, [tag2int(tag) for tag in tags])
+            if '0020|000e' in tags and 0x0020000E not in elements:
+                # 每个图像文件都有SeriesInstanceUID，缺少时交给SimpleITK确认，避免以空的SeriesID入库
+                raise UnsupportedDicomError('Missing SeriesInstanceUID')
+        except UnsupportedDicomError:
+            if isinstance(dcm_file, (bytes, bytearray)):
+                raise
+        else:
+            # 可选标签缺失很常见，直接使用默认值，不在扫描大量文件的进程池中逐个输出
+            tag_value = {}
+            for tag in tags:
+                element = elements.get(tag2int(tag))
+                tag_value[tag] = default if element is None else element2str(*element).strip()
+            return tag_value
+    dcm = read_header(dcm_file)
     tag_value = {}
     for tag in tags:
         try:
@@ -68,6 +433,7 @@ def read_specific_tags(dcm_file, tags: list, default=""):
 
 
 def read_series_in_dir(dir):
+    import SimpleITK as sitk
     reader = sitk.ImageSeriesReader()
     series_ids = reader.GetGDCMSeriesIDs(dir)
     return series_ids
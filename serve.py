@@ -0,0 +1,95 @@
+"""
+多worker服务入口：在父进程中加载所有模型，把权重移动到共享内存后再fork出多个worker，共同监听同一个端口，
+所有worker使用父进程中的同一份模型权重，增加worker只增加各自的运行时内存，不再每个worker加载一份模型
+与uvicorn --workers(每个worker是新启动的进程，各自导入main并加载模型)不同，这里依赖fork，只能在Linux等POSIX系统上使用
+使用GPU推理时CUDA上下文不能跨fork共享，此时不在父进程中加载模型，由每个worker各自加载
+用法：python serve.py [--host 0.0.0.0] [--port 5231] [--workers 4]
+"""
+import argparse
+import gc
+import os
+import signal
+import uvicorn
+from loguru import logger
+from config import *
+
+
+def preload_shared_models():
+    """
+    在父进程中导入服务并加载模型，返回FastAPI应用
+    """
+    import main
+    from model_backend import model_registry, use_cuda
+    # 导入时建表和迁移打开的数据库连接不能被子进程继承使用，fork前全部关闭
+    dispose_engines()
+    if use_cuda:
+        logger.warning('使用GPU推理时无法在worker之间共享模型，每个worker将各自加载模型')
+        return main.app
+    model_registry.preload(share_memory=True)
+    # 父进程中已有的对象不再被子进程的垃圾回收扫描，避免改写其对象头导致内存页被复制
+    gc.collect()
+    gc.freeze()
+    return main.app
+
+
+def fork_workers(workers: int, target, *args):
+    """
+    fork出workers个子进程执行target(*args)，子进程在target返回后退出
+    :return: 子进程pid列表
+    """
+    pids = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                target(*args)
+            except BaseException:
+                logger.exception(f'worker进程{os.getpid()}异常退出')
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        pids.append(pid)
+    return pids
+
+
+def run_worker(server_config: uvicorn.Config, sock):
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    uvicorn.Server(server_config).run(sockets=[sock])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='在多个worker进程之间共享模型权重的服务入口')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5231)
+    parser.add_argument('--workers', type=int, default=serve_config['workers'])
+    args = parser.parse_args()
+
+    app = preload_shared_models()
+    server_config = uvicorn.Config(app, host=args.host, port=args.port)
+    sock = server_config.bind_socket()
+    pids = fork_workers(args.workers, run_worker, server_config, sock)
+    logger.info(f'已启动{len(pids)}个worker进程：{pids}')
+
+    stopping = []
+
+    def stop_workers(signum, frame):
+        stopping.append(signum)
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop_workers)
+    signal.signal(signal.SIGTERM, stop_workers)
+    for pid in pids:
+        _, status = os.waitpid(pid, 0)
+        if status and not stopping:
+            logger.warning(f'worker进程{pid}退出，状态码{status}')
+    sock.close()
+
+
+if __name__ == '__main__':
+    main()
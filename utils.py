@@ -2,17 +2,57 @@ import zipfile
 from tempfile import TemporaryDirectory
 import os
 import shutil
+import hashlib
+import threading
+import time
+import uuid
 
 
 def zip2dicom_dir(zipfile_path, output_path):
+    """
+    将zip中的所有dcm文件直接流式写出到output_path，不再先解压到临时目录再复制
+    :param zipfile_path: zip文件路径或可随机访问的二进制文件对象(如UploadFile.file)
+    :return: 写出的dcm文件路径列表
+    """
     os.makedirs(output_path, exist_ok=True)
-    with TemporaryDirectory() as tmpdir:
-        z = zipfile.ZipFile(zipfile_path, 'r')
-        z.extractall(path=tmpdir)
-        for root, dirs, files in os.walk(tmpdir):
-            for file in files:
-                if os.path.splitext(file)[-1] == '.dcm':
-                    shutil.copyfile(os.path.join(root, file), os.path.join(output_path, file))
+    output_files = []
+    with zipfile.ZipFile(zipfile_path, 'r') as z:
+        for member in z.infolist():
+            filename = os.path.split(member.filename)[-1]
+            if member.is_dir() or os.path.splitext(filename)[-1] != '.dcm':
+                continue
+            output_file = os.path.join(output_path, filename)
+            with z.open(member) as src, open(output_file, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            output_files.append(output_file)
+    return output_files
+
+
+class InvalidUploadError(ValueError):
+    """
+    上传的zip文件不符合要求，异常信息为返回给客户端的说明
+    """
+    pass
+
+
+def read_zip_dicom_members(zipfile_path, expected_count: int = None, max_member_bytes: int = None):
+    """
+    直接在内存中读取zip中所有dcm文件的内容，不写出到磁盘
+    先根据zip目录检查文件数量和解压后的大小，不符合要求时不解压任何文件，内存占用不随上传文件增大
+    :param zipfile_path: zip文件路径或可随机访问的二进制文件对象(如UploadFile.file)
+    :param expected_count: dcm文件数量不等于该值时抛出InvalidUploadError
+    :param max_member_bytes: 单个dcm文件解压后超过该字节数时抛出InvalidUploadError
+    :return: [(文件名, 文件内容bytes), ...]
+    """
+    with zipfile.ZipFile(zipfile_path, 'r') as z:
+        dicom_members = [member for member in z.infolist() if not member.is_dir() and
+                         os.path.splitext(member.filename)[-1] == '.dcm']
+        if expected_count is not None and len(dicom_members) != expected_count:
+            raise InvalidUploadError(f'仅支持上传包含{expected_count}帧的Dicom序列')
+        if max_member_bytes is not None and any(member.file_size > max_member_bytes for member in dicom_members):
+            raise InvalidUploadError(f'zip中单个Dicom文件解压后不能超过{max_member_bytes / 1024 ** 2:g}MB')
+        # zipfile最多解压出目录中记录的file_size字节，实际数据更长时校验失败并抛出BadZipFile
+        return [(os.path.split(member.filename)[-1], z.read(member)) for member in dicom_members]
 
 
 def dicom_files2zip(dicom_files: list, zip_output_path):
@@ -21,6 +61,158 @@ def dicom_files2zip(dicom_files: list, zip_output_path):
             zf.write(filename=path, arcname=os.path.split(path)[-1])
 
 
+class _ZipStreamBuffer:
+    """
+    只能顺序写入的缓冲区，zipfile检测到不可seek时会改用数据描述符，从而可以边写边输出
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def iter_dicom_zip(dicom_files: list, chunk_size: int = 1024 * 1024):
+    """
+    边读取Dicom文件边生成zip内容，文件以存储方式(不压缩)写入，Dicom像素数据压缩率很低
+    :return: 生成器，逐块产出zip文件的bytes
+    """
+    buffer = _ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, mode='w', compression=zipfile.ZIP_STORED) as zf:
+        for path in dicom_files:
+            zinfo = zipfile.ZipInfo.from_file(path, arcname=os.path.split(path)[-1])
+            with open(path, 'rb') as src, zf.open(zinfo, mode='w') as dst:
+                while True:
+                    chunk = src.read(chunk_size)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    yield buffer.pop()
+    yield buffer.pop()
+
+
+class ZipArchiveCache:
+    """
+    预先生成的Series压缩包磁盘缓存，按最近访问时间(mtime)进行LRU淘汰，总大小不超过max_bytes
+    discard时为Series写入一个内容随机的标记文件，正在生成的压缩包发现标记变化后不放入缓存，
+    建库和删除可以在其他进程中进行，因此标记保存在缓存目录中，超过discard_marker_ttl后由evict清理
+    """
+    discard_marker_ttl = 24 * 3600
+
+    def __init__(self, cache_dir, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, series_id):
+        return os.path.join(self.cache_dir, hashlib.sha1(series_id.encode()).hexdigest() + '.zip')
+
+    def _marker_path(self, series_id):
+        return os.path.splitext(self._path(series_id))[0] + '.discarded'
+
+    def _discard_token(self, series_id):
+        try:
+            with open(self._marker_path(series_id), 'r') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def get(self, series_id):
+        """
+        命中时刷新访问时间并返回缓存文件路径，未命中返回None
+        """
+        path = self._path(series_id)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def tee(self, series_id, chunks):
+        """
+        将流式生成的zip内容原样转发，同时写入临时文件，完整写完后原子替换为缓存文件
+        并发下载同一Series时各自写入不同的临时文件，不会互相覆盖；
+        开始生成后Series被discard时，替换后再删除该缓存文件，避免缓存过期的压缩包
+        """
+        path = self._path(series_id)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        discard_token = self._discard_token(series_id)
+        completed = False
+        try:
+            with open(tmp_path, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+            os.replace(tmp_path, path)
+            completed = True
+            # 在替换之后检查标记：discard先写标记再删除缓存文件，两者无论如何交错，过期的压缩包都不会留下
+            if self._discard_token(series_id) != discard_token:
+                self._remove(path)
+            else:
+                self.evict()
+        finally:
+            if not completed and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def discard(self, series_id):
+        """
+        Series的文件发生变化(删除或重新建库)时删除其缓存压缩包，并使正在生成的压缩包不再放入缓存
+        """
+        marker_path = self._marker_path(series_id)
+        tmp_path = f"{marker_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(uuid.uuid4().hex)
+        os.replace(tmp_path, marker_path)
+        self._remove(self._path(series_id))
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            now = time.time()
+            for filename in os.listdir(self.cache_dir):
+                extension = os.path.splitext(filename)[-1]
+                if extension not in ('.zip', '.discarded'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, filename))
+                except FileNotFoundError:
+                    continue
+                if extension == '.discarded':
+                    if now - stat.st_mtime > self.discard_marker_ttl:
+                        self._remove(os.path.join(self.cache_dir, filename))
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, filename))
+            total = sum(entry[1] for entry in entries)
+            for _, size, filename in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                self._remove(os.path.join(self.cache_dir, filename))
+                total -= size
+
+
 if __name__ == '__main__':
     with TemporaryDirectory() as tmpdir:
         zip2dicom_dir('test.zip', tmpdir)
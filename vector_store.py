@@ -0,0 +1,139 @@
+"""
+持久化的特征向量库：
+建库和重建索引时计算出的特征向量与IndexID一起追加保存到磁盘，重建索引(删除数据或修改索引类型后)时直接读取，不再重新推理
+每种断层扫描类型使用type_config中vector_store指定的目录，包含：
+1. ids.i64：IndexID数组(int64)
+2. vectors.f32：特征向量矩阵(float32，行数与ids.i64相同)，以内存映射方式读取
+3. meta.json：向量维度、有效行数和生成这些向量的模型版本(模型文件的sha1)，模型文件更新后旧向量自动失效
+追加时先写数据文件，再原子更新meta.json中的有效行数，中断后多写入的部分会在下次打开时被截断
+"""
+import hashlib
+import json
+import os
+import numpy as np
+from loguru import logger
+from config import *
+
+
+def model_version(tomography_type):
+    """
+    以模型文件内容的sha1作为模型版本
+    """
+    sha1 = hashlib.sha1()
+    with open(type_config[tomography_type]['model_file'], 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class FeatureVectorStore:
+    def __init__(self, tomography_type, version: str = None):
+        """
+        :param version: 生成向量的模型版本，默认为当前模型文件的sha1
+        """
+        self.tomography_type = tomography_type
+        self.directory = type_config[tomography_type]['vector_store']
+        self.dim = type_config[tomography_type]['feature_vector_length']
+        self.version = version or model_version(tomography_type)
+        self._ids_file = os.path.join(self.directory, 'ids.i64')
+        self._vectors_file = os.path.join(self.directory, 'vectors.f32')
+        self._meta_file = os.path.join(self.directory, 'meta.json')
+        self.count = self._open()
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        count = 0
+        if os.path.exists(self._meta_file):
+            with open(self._meta_file, 'r') as f:
+                meta = json.load(f)
+            if meta['model_version'] == self.version and meta['dim'] == self.dim:
+                count = meta['count']
+            else:
+                logger.warning(f'{self.tomography_type}特征向量库的模型版本或向量维度与当前模型不一致，已清空旧向量')
+        # 截断上次中断时多写入的部分
+        for path, row_bytes in ((self._ids_file, 8), (self._vectors_file, 4 * self.dim)):
+            with open(path, 'ab') as f:
+                f.truncate(count * row_bytes)
+        self._write_meta(count)
+        return count
+
+    def _write_meta(self, count):
+        tmp_file = f'{self._meta_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'model_version': self.version, 'dim': self.dim, 'count': count}, f)
+        os.replace(tmp_file, self._meta_file)
+
+    def append(self, ids_array, features_array):
+        ids_array = np.ascontiguousarray(ids_array, dtype='int64')
+        features_array = np.ascontiguousarray(features_array, dtype='float32').reshape(-1, self.dim)
+        with open(self._ids_file, 'ab') as f:
+            f.write(ids_array.tobytes())
+        with open(self._vectors_file, 'ab') as f:
+            f.write(features_array.tobytes())
+        self.count += len(ids_array)
+        self._write_meta(self.count)
+
+    def record(self, batches):
+        """
+        将流水线产出的(ids_array, features_array)批次追加到向量库，并原样产出
+        """
+        for ids_array, features_array in batches:
+            self.append(ids_array, features_array)
+            yield ids_array, features_array
+
+    def load(self):
+        """
+        :return: (ids, vectors)，均为只读的内存映射数组
+        """
+        if not self.count:
+            return np.empty(0, dtype='int64'), np.empty((0, self.dim), dtype='float32')
+        ids = np.memmap(self._ids_file, dtype='int64', mode='r', shape=(self.count,))
+        vectors = np.memmap(self._vectors_file, dtype='float32', mode='r', shape=(self.count, self.dim))
+        return ids, vectors
+
+    def latest_mask(self, live_ids):
+        """
+        同一IndexID被多次追加时只保留最后一次，并且只保留live_ids中的IndexID
+        :return: 与向量库行数相同的bool数组
+        """
+        ids, _ = self.load()
+        mask = np.zeros(len(ids), dtype=bool)
+        if not len(ids):
+            return mask
+        _, last_positions = np.unique(ids[::-1], return_index=True)
+        mask[len(ids) - 1 - last_positions] = True
+        mask &= np.isin(ids, live_ids)
+        return mask
+
+    def iter_batches(self, mask=None, batch_rows: int = 65536):
+        """
+        按块读取向量库，每次产出(ids_array, features_array)
+        :param mask: 可选，只读取mask为True的行
+        """
+        ids, vectors = self.load()
+        for start in range(0, len(ids), batch_rows):
+            end = start + batch_rows
+            if mask is None:
+                yield np.array(ids[start:end]), np.array(vectors[start:end])
+            elif mask[start:end].any():
+                yield ids[start:end][mask[start:end]], vectors[start:end][mask[start:end]]
+
+    def compact(self, mask):
+        """
+        只保留mask为True的行，重写数据文件
+        重写期间有效行数先置为0，中断时向量库为空，之后的重建会重新推理，不会读到错位的数据
+        """
+        tmp_ids_file = f'{self._ids_file}.tmp'
+        tmp_vectors_file = f'{self._vectors_file}.tmp'
+        kept = 0
+        with open(tmp_ids_file, 'wb') as ids_f, open(tmp_vectors_file, 'wb') as vectors_f:
+            for ids_array, features_array in self.iter_batches(mask):
+                ids_f.write(ids_array.tobytes())
+                vectors_f.write(features_array.tobytes())
+                kept += len(ids_array)
+        self._write_meta(0)
+        os.replace(tmp_ids_file, self._ids_file)
+        os.replace(tmp_vectors_file, self._vectors_file)
+        logger.info(f'特征向量库整理完成：{self.count}行 -> {kept}行')
+        self.count = kept
+        self._write_meta(kept)